@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+'''Microbenchmarks for libirc. Run: python3 bench_libirc.py [rounds]'''
+
+import sys
+import time
+
+import libirc
+
+# received lines, by traffic pattern
+CORPORA = {
+    'privmsg': [
+        ':nick!~user@host.example.com PRIVMSG #channel :Hello, world! How is everyone today?',
+        ':nick!~user@host.example.com PRIVMSG #channel :\x01ACTION waves at everyone\x01',
+        ':nick!~user@host.example.com PRIVMSG relaybot :\x01PING 1445444940\x01',
+        ':nick!~user@host.example.com PRIVMSG relaybot :\x01VERSION\x01',
+        '@time=2015-10-21T16:29:00.000Z;account=alice :alice!~a@host PRIVMSG #channel :tagged message',
+    ],
+    'joinpart': [
+        ':alice!~a@gateway/web/irccloud.com/x-abcdef JOIN #channel',
+        ':bob!~b@2001:db8::1 PART #channel :Leaving',
+        ':carol!~c@host QUIT :*.net *.split',
+        ':dave!~d@unaffiliated/dave JOIN #channel',
+        ':erin!~e@host PART #channel',
+        ':op!~op@host KICK #channel spammer :no spamming',
+    ],
+    'numeric': [
+        ':server.example.net 001 relaybot :Welcome to the Example IRC Network relaybot',
+        ':server.example.net 005 relaybot CHANTYPES=# EXCEPTS INVEX CHANMODES=eIbq,k,flj,CFLMPQScgimnprstz :are supported by this server',
+        ':server.example.net 332 relaybot #channel :Channel topic | https://example.com/',
+        ':server.example.net 353 relaybot = #channel :@op +voice alice bob carol dave erin frank grace',
+        ':server.example.net 366 relaybot #channel :End of /NAMES list.',
+        'PING :server.example.net',
+    ],
+    'utf8': [
+        ':nick!~user@host PRIVMSG #channel :' + '你好，世界！这是一条很长的消息。' * 12,
+        ':nick!~user@host PRIVMSG #channel :' + 'Ünïcödé ẗëẍẗ wïẗḧ ḋïäċṙïẗïċṡ ' * 12,
+        ':nick!~user@host PRIVMSG #channel :' + '🎉🚀✨ emoji party ' * 20,
+    ],
+}
+
+# sent messages: (destination, text)
+SEND_CORPUS = [
+    ('#channel', '[alice] Hello, world! How is everyone today?'),
+    ('#channel', '[bob] ' + '你好，世界！这是一条很长的消息。' * 8),
+    ('#channel', '[carol] first line\nsecond line\nthird line'),
+    ('nick', 'a private reply'),
+]
+
+
+class NullSocket(object):
+    '''Swallows whatever is sent.'''
+
+    def sendall(self, data):
+        pass
+
+
+def bench(name, func, rounds):
+    start = time.perf_counter()
+    n = func(rounds)
+    elapsed = time.perf_counter() - start
+    print('%-24s %10.0f lines/s %8.0f ns/line' % (name, n / elapsed, elapsed * 1e9 / n))
+
+
+def make_parse(corpus):
+    def run(rounds):
+        parse_line = libirc.parse_line
+        for _ in range(rounds):
+            for line in corpus:
+                parse_line(line)
+        return rounds * len(corpus)
+    return run
+
+
+def make_parse_many(corpus):
+    # about what one recvlines() returns during a burst
+    batch = corpus * 8
+
+    def run(rounds):
+        parse_many = libirc.parse_many
+        for _ in range(rounds // 8):
+            parse_many(batch)
+        return rounds // 8 * len(batch)
+    return run
+
+
+def make_recvline(corpus):
+    data = ''.join(line + '\r\n' for line in corpus).encode('utf-8') * 8
+    count = len(corpus) * 8
+
+    def run(rounds):
+        conn = libirc.IRCConnection()
+        recvline = conn.recvline
+        for _ in range(rounds // 8):
+            conn.recvbuf[:] = data
+            conn.recvscan = 0
+            for _ in range(count):
+                recvline()
+        return rounds // 8 * count
+    return run
+
+
+def make_recvlines(corpus):
+    data = ''.join(line + '\r\n' for line in corpus).encode('utf-8') * 8
+    count = len(corpus) * 8
+
+    def run(rounds):
+        conn = libirc.IRCConnection()
+        recvlines = conn.recvlines
+        for _ in range(rounds // 8):
+            conn.recvbuf[:] = data
+            conn.recvscan = 0
+            recvlines()
+        return rounds // 8 * count
+    return run
+
+
+def connection():
+    conn = libirc.IRCConnection()
+    conn.sock = NullSocket()
+    return conn
+
+
+def run_quote(rounds):
+    conn = connection()
+    quote = conn.quote
+    lines = ['PRIVMSG %s :%s' % item for item in SEND_CORPUS]
+    for _ in range(rounds):
+        for line in lines:
+            quote(line)
+    # or __del__ quits
+    conn.sock = None
+    return rounds * len(lines)
+
+
+def run_say(rounds):
+    conn = connection()
+    say = conn.say
+    for _ in range(rounds):
+        for dest, text in SEND_CORPUS:
+            say(dest, text)
+    conn.sock = None
+    return rounds * sum(len(text.splitlines()) for dest, text in SEND_CORPUS)
+
+
+def run_say_queued(rounds):
+    conn = connection()
+    # as relay.py does, without starting the thread
+    conn.sendqueue = libirc.SendQueue(conn, 1, 1)
+    say = conn.say
+    for _ in range(rounds):
+        for dest, text in SEND_CORPUS:
+            say(dest, text)
+        del conn.sendqueue.queue[:]
+    conn.sendqueue = conn.sock = None
+    return rounds * sum(len(text.splitlines()) for dest, text in SEND_CORPUS)
+
+
+def make_helper(func, args):
+    def run(rounds):
+        for _ in range(rounds):
+            for arg in args:
+                func(arg)
+        return rounds * len(args)
+    return run
+
+
+def main(rounds=20000):
+    for name, corpus in sorted(CORPORA.items()):
+        bench('parse_line/' + name, make_parse(corpus), rounds)
+    for name, corpus in sorted(CORPORA.items()):
+        bench('parse_many/' + name, make_parse_many(corpus), rounds)
+    for name, corpus in sorted(CORPORA.items()):
+        bench('recvline/' + name, make_recvline(corpus), rounds)
+    for name, corpus in sorted(CORPORA.items()):
+        bench('recvlines/' + name, make_recvlines(corpus), rounds)
+    bench('quote', run_quote, rounds)
+    bench('say', run_say, rounds)
+    bench('say/queued', run_say_queued, rounds)
+    dests = ['#channel', '#other', ['#a', '#b'], 'nick']
+    texts = [text for dest, text in SEND_CORPUS]
+    bench('catchannel', make_helper(libirc.catchannel, dests), rounds)
+    bench('tolist', make_helper(libirc.tolist, dests), rounds)
+    bench('rmnl', make_helper(libirc.rmnl, texts), rounds)
+    bench('rmcr', make_helper(libirc.rmcr, texts), rounds)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''A log of the raw input of the relay, for replay.py.'''
+
+import json
+import time
+import threading
+
+__all__ = ['CaptureWriter', 'read']
+
+
+class CaptureWriter:
+    '''
+    Append raw input to a file, one record per line:
+
+        <unix time>\\t<source>\\t<payload>
+
+    where source is "tg" with the JSON of a list of updates as payload,
+    or "irc" with a raw IRC line.
+    '''
+
+    def __init__(self, path):
+        self.fp = open(path, 'a', encoding='utf-8', buffering=1)
+        self.lock = threading.Lock()
+
+    def write(self, source, payload):
+        with self.lock:
+            self.fp.write('%.3f\t%s\t%s\n' % (time.time(), source, payload))
+
+    def tg(self, updates):
+        self.write('tg', json.dumps(updates, ensure_ascii=False, separators=(',', ':')))
+
+    def irc(self, line):
+        self.write('irc', line)
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+
+def read(path):
+    '''Yields (time, source, payload) of a capture, with tg payloads decoded.'''
+    with open(path, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            ts, source, payload = line.split('\t', 2)
+            if source == 'tg':
+                payload = json.loads(payload)
+            yield float(ts), source, payload
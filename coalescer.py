@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Join bursts of small items into batches.'''
+
+import time
+import logging
+import threading
+
+__all__ = ['Coalescer']
+
+LOG = logging.getLogger(__name__)
+
+
+class Coalescer:
+    '''
+    Collect items added under the same key into a batch, which is handed
+    to flush(key, items) `window` seconds after its first item was added,
+    or before adding an item would make its total size go over `limit`.
+
+    The first item after `window` seconds without a flush of its key is
+    flushed at once on its own, so a lone item doesn't wait; only the
+    items that follow it are batched.
+
+    flush() is called with the lock held, so batches of a key are flushed
+    in order. It should be quick, like submitting the batch to a
+    Dispatcher.
+    '''
+
+    def __init__(self, flush, window=1, limit=4096, name='Coalescer'):
+        self.flushfunc = flush
+        self.window = window
+        self.limit = limit
+        # key -> [deadline, total size, items], the first key is due first
+        self.batches = {}
+        # key -> when the last flush of the key was
+        self.flushed = {}
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, key, item, size):
+        with self.cond:
+            batch = self.batches.get(key)
+            if batch is None and self.flushed.get(key, -self.window) + self.window <= time.monotonic():
+                self.batches[key] = [0, size, [item]]
+                self._flush(key)
+                return
+            if batch is not None and batch[1] + size > self.limit:
+                self._flush(key)
+                batch = None
+            if batch is None:
+                batch = self.batches[key] = [time.monotonic() + self.window, 0, []]
+                if len(self.batches) == 1:
+                    self.cond.notify()
+            batch[1] += size
+            batch[2].append(item)
+
+    def flush(self, key=None):
+        '''Flush the batch of key now, or all batches if key is None.'''
+        with self.cond:
+            if key is None:
+                for key in list(self.batches):
+                    self._flush(key)
+            elif key in self.batches:
+                self._flush(key)
+
+    def _flush(self, key):
+        items = self.batches.pop(key)[2]
+        self.flushed[key] = time.monotonic()
+        try:
+            self.flushfunc(key, items)
+        except Exception:
+            LOG.exception('Flushing %d items for %r failed.', len(items), key)
+
+    def run(self):
+        with self.cond:
+            while 1:
+                if not self.batches:
+                    self.cond.wait()
+                    continue
+                key = next(iter(self.batches))
+                delay = self.batches[key][0] - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)
+                else:
+                    self._flush(key)
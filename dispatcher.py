@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''A thread pool that keeps tasks for the same destination in order.'''
+
+import time
+import logging
+import threading
+import collections
+
+__all__ = ['Dispatcher']
+
+LOG = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    '''
+    Run tasks in `workers` threads, with one FIFO queue per destination key.
+
+    Tasks with the same key run one at a time, in the order they were
+    submitted. Different keys run in parallel and take turns, so a slow
+    destination only holds up its own queue.
+    '''
+
+    def __init__(self, workers=3, name='Dispatcher'):
+        # key -> deque of (enqueue time, func, args, kwargs), the head is running or next
+        self.queues = {}
+        # keys that have tasks and no task running
+        self.ready = collections.deque()
+        self.cond = threading.Condition()
+        self.threads = []
+        for i in range(workers):
+            thr = threading.Thread(target=self.run, name='%s-%d' % (name, i))
+            thr.daemon = True
+            thr.start()
+            self.threads.append(thr)
+
+    def submit(self, key, func, *args, **kwargs):
+        with self.cond:
+            q = self.queues.get(key)
+            if q is None:
+                q = self.queues[key] = collections.deque()
+                self.ready.append(key)
+                self.cond.notify()
+            q.append((time.monotonic(), func, args, kwargs))
+
+    def run(self):
+        while 1:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                key = self.ready.popleft()
+                q = self.queues[key]
+                queued, func, args, kwargs = q[0]
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                LOG.exception('Dispatched task for %r failed.', key)
+            with self.cond:
+                q.popleft()
+                if q:
+                    self.ready.append(key)
+                    self.cond.notify()
+                else:
+                    del self.queues[key]
+
+    def stats(self):
+        '''Returns {key: (queue depth, seconds the head task has waited)}.'''
+        now = time.monotonic()
+        with self.cond:
+            return {key: (len(q), now - q[0][0]) for key, q in self.queues.items()}
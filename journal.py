@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Crash-safe storage of a small key-value state.'''
+
+import os
+import json
+import threading
+
+__all__ = ['StateJournal', 'IdAllocator']
+
+
+class StateJournal:
+    '''
+    An append-only journal of a small JSON-serializable key-value state.
+
+    Every line of the file is a JSON object of changed keys, applied in
+    order on load. Changes are written and fsync'ed in batches at most
+    every `interval` seconds by a background thread, so a crash loses at
+    most that much. When the file grows over `maxsize` bytes, it is
+    compacted into a single line holding the whole state.
+    '''
+
+    def __init__(self, path, interval=1, maxsize=1 << 20):
+        self.path = path
+        self.interval = interval
+        self.maxsize = maxsize
+        self.state = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        clean = self.load()
+        self.fp = open(self.path, 'a', encoding='utf-8')
+        if not clean:
+            self.compact()
+        self.thread = threading.Thread(target=self.run, name='StateJournal')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load(self):
+        '''
+        Read the journal. Returns False if a line is damaged or the last
+        one is torn (has no newline), so that the file is compacted before
+        anything is appended to it. The lines around a damaged one still
+        count.
+        '''
+        try:
+            fp = open(self.path, 'r', encoding='utf-8', errors='replace')
+        except FileNotFoundError:
+            return True
+        clean = True
+        with fp:
+            for line in fp:
+                if not line.endswith('\n'):
+                    clean = False
+                try:
+                    self.state.update(json.loads(line))
+                except (ValueError, TypeError):
+                    clean = False
+        return clean
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.state
+
+    def set(self, key, value):
+        with self.lock:
+            if key in self.state and self.state[key] == value:
+                return
+            self.state[key] = value
+            self.pending[key] = value
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            self.fp.write(json.dumps(self.pending, sort_keys=True) + '\n')
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            self.pending = {}
+            if self.fp.tell() > self.maxsize:
+                self._compact()
+
+    def compact(self):
+        '''Rewrite the journal as a single line.'''
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        tmpname = self.path + '.tmp'
+        with open(tmpname, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps(self.state, sort_keys=True) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmpname, self.path)
+        self.fp.close()
+        self.fp = open(self.path, 'a', encoding='utf-8')
+        self.pending = {}
+
+    def run(self):
+        while not self.closed.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.compact()
+        self.fp.close()
+
+
+class IdAllocator:
+    '''
+    Allocate increasing integers that stay unique across restarts.
+
+    Ids are reserved from a StateJournal in blocks of `block`, and the
+    reservation is flushed before any id from it is handed out. After a
+    crash, the unused rest of the last block is skipped.
+    '''
+
+    def __init__(self, state, key, start=0, block=1000):
+        self.state = state
+        self.key = key
+        self.block = block
+        self.next = max(state.get(key, 0), start)
+        self.limit = self.next
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            if self.next >= self.limit:
+                self.limit = self.next + self.block
+                self.state.set(self.key, self.limit)
+                self.state.flush()
+            ret = self.next
+            self.next += 1
+            return ret
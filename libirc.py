@@ -2,22 +2,38 @@
 
 '''A Python module that allows you to connect to IRC in a simple way.'''
 
+import collections
 import errno
+import heapq
+import itertools
+import select
 import socket
 import ssl
 import sys
 import threading
 import time
 
-__all__ = ['IRCConnection', 'IRCClient']
+from ratelimit import TokenBucket
 
-DEFAULT_BUFFER_LENGTH = 1024
+__all__ = ['IRCConnection', 'IRCClient', 'IRCMessage', 'SendQueue', 'TokenBucket', 'parse_line', 'parse_many']
+
+DEFAULT_BUFFER_LENGTH = 4096
+MAX_BUFFER_LENGTH = 65536
 
 if sys.version_info >= (3,):
     tostr = str
 else:
     tostr = unicode
 
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Lines with lower numbers are sent first when the send queue is throttled.
+SEND_PRIORITY = {
+    'PONG': 0, 'PING': 0, 'PASS': 0, 'NICK': 0, 'USER': 0, 'CAP': 0, 'QUIT': 0,
+    'JOIN': 1, 'PART': 1, 'MODE': 1, 'TOPIC': 1, 'KICK': 1, 'INVITE': 1, 'AWAY': 1,
+}
+DEFAULT_SEND_PRIORITY = 2
+
 
 def stripcomma(s):
     '''Delete the comma if the string starts with a comma.'''
@@ -43,7 +59,19 @@ def tolist(s, f=None):
         return list(map(f, tolist(s)))
 
 
+# catchannel() of single destinations, which are few and repeat on every line
+_CHANNEL_CACHE = {}
+_CHANNEL_CACHE_SIZE = 256
+
+
 def catchannel(s):
+    if isinstance(s, (str, tostr)):
+        ret = _CHANNEL_CACHE.get(s)
+        if ret is None:
+            ret = rmnlsp(s)
+            if len(_CHANNEL_CACHE) < _CHANNEL_CACHE_SIZE:
+                _CHANNEL_CACHE[s] = ret
+        return ret
     return ','.join(tolist(s, rmnlsp))
 
 
@@ -62,15 +90,216 @@ def rmcr(s):
     return tostr(s).replace('\r', '')
 
 
+TAG_ESCAPES = {':': ';', 's': ' ', 'r': '\r', 'n': '\n', '\\': '\\'}
+
+
+def unescape_tag(value):
+    '''Unescape an IRCv3 message tag value.'''
+    if '\\' not in value:
+        return value
+    ret = []
+    chars = iter(value)
+    for c in chars:
+        if c == '\\':
+            c = next(chars, '')
+            ret.append(TAG_ESCAPES.get(c, c))
+        else:
+            ret.append(c)
+    return ''.join(ret)
+
+
+def parse_tags(s):
+    '''Parse IRCv3 message tags (without the leading '@') into a dict.'''
+    tags = {}
+    for tag in s.split(';'):
+        if tag:
+            key, sep, value = tag.partition('=')
+            tags[key] = unescape_tag(value) if sep else None
+    return tags
+
+
+class IRCMessage(collections.namedtuple('IRCMessage', 'tags prefix nick ident cmd dest msg args')):
+    '''A parsed IRC line. 'args' is the raw parameter string after the command.\nFields can also be read like a dict, eg. msg['nick'].'''
+
+    __slots__ = ()
+
+    @property
+    def user(self):
+        if self.ident is not None:
+            return self.ident.partition('@')[0]
+
+    @property
+    def host(self):
+        if self.ident is not None:
+            return self.ident.partition('@')[2] or None
+        elif self.prefix is not None:
+            return self.prefix.partition('@')[2] or None
+
+    @property
+    def params(self):
+        '''All parameters as a list, the trailing one included.'''
+        args = self.args
+        if args[:1] == ':':
+            return [args[1:]]
+        head, sep, trailing = args.partition(' :')
+        params = head.split()
+        if sep:
+            params.append(trailing)
+        return params
+
+    def __getitem__(self, key):
+        if isinstance(key, (str, tostr)):
+            if key not in _MESSAGE_KEYS:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key not in _MESSAGE_KEYS:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return self._fields
+
+
+# what msg['key'] can read, not the tuple methods
+_MESSAGE_KEYS = frozenset(IRCMessage._fields + ('user', 'host', 'params'))
+
+_new_message = tuple.__new__
+
+
+def parse_line(line):
+    '''Parse a raw IRC line into an IRCMessage.\nThe 'dest' and 'msg' fields keep the meaning of the old dict interface: 'dest' is the first middle parameter (a (channel, nick) tuple for KICK), 'msg' is the rest with the leading ':' stripped.'''
+    tags = prefix = nick = ident = None
+    if line[:1] == '@':
+        tagstr, _, line = line.partition(' ')
+        tags = parse_tags(tagstr[1:])
+        line = line.lstrip(' ')
+    if line[:1] == ':':
+        prefix, _, line = line.partition(' ')
+        prefix = prefix[1:]
+        nick, sep, ident = prefix.partition('!')
+        if not sep:
+            ident = None
+            nick = nick.partition('@')[0]
+    cmd, _, args = line.partition(' ')
+    if not cmd:
+        return _new_message(IRCMessage, (tags, prefix, nick, ident, None, None, None, args))
+    if not args:
+        dest = msg = None
+    elif args[0] == ':':
+        dest = None
+        msg = args[1:]
+    elif cmd == 'PING':
+        dest = None
+        msg = args
+    else:
+        dest, sep, rest = args.partition(' ')
+        if cmd == 'KICK':
+            if sep:
+                dest2, sep, rest = rest.partition(' ')
+                dest = (dest, dest2)
+            else:
+                dest = (None, dest)
+        if sep:
+            msg = rest[1:] if rest[:1] == ':' else rest
+        else:
+            msg = None
+    return _new_message(IRCMessage, (tags, prefix, nick, ident, cmd, dest, msg, args))
+
+
+def parse_many(lines):
+    '''Parse a list of raw IRC lines, skipping empty ones.'''
+    return [parse_line(line) for line in lines if line]
+
+
+class SendQueue(threading.Thread):
+    '''Send lines for an IRCConnection in a background thread, paced by a TokenBucket.\nLines go out by priority (see SEND_PRIORITY), then in the order they are put.'''
+
+    def __init__(self, conn, rate, burst):
+        threading.Thread.__init__(self, name='IRCSendQueue')
+        self.daemon = True
+        self.conn = conn
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = []
+        self.cond = threading.Condition()
+        self.counter = itertools.count()
+        self.running = True
+        self.sent = 0
+        self.dropped = 0
+        self.wait_total = 0.
+        self.wait_max = 0.
+        # called with the seconds each line waited, if set
+        self.onsend = None
+
+    def put(self, line, priority=DEFAULT_SEND_PRIORITY):
+        '''Queue an encoded line (with the trailing CRLF). Returns immediately.'''
+        with self.cond:
+            if not self.running:
+                self.dropped += 1
+                return
+            heapq.heappush(self.queue, (priority, next(self.counter), monotonic(), line))
+            self.cond.notify()
+
+    def run(self):
+        while 1:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.running:
+                    return
+            self.bucket.wait()
+            with self.cond:
+                if not self.queue:
+                    continue
+                priority, _, queued, line = heapq.heappop(self.queue)
+            waited = monotonic() - queued
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            if self.onsend is not None:
+                self.onsend(waited)
+            try:
+                self.conn.send(line)
+                self.sent += 1
+            except socket.error:
+                self.dropped += 1
+                self.stop()
+
+    def stop(self):
+        '''Stop the thread and drop all queued lines.'''
+        with self.cond:
+            self.running = False
+            self.dropped += len(self.queue)
+            del self.queue[:]
+            self.cond.notify()
+
+    def stats(self):
+        '''Returns queue depth and counters as a dict.'''
+        with self.cond:
+            depth = len(self.queue)
+        return {
+            'depth': depth,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+        }
+
+
 class IRCConnection:
 
     def __init__(self):
         self.addr = None
         self.nick = None
         self.sock = None
-        self.recvbuf = b''
+        self.recvbuf = bytearray()
+        self.recvscan = 0
         self.sendbuf = b''
         self.buffer_length = DEFAULT_BUFFER_LENGTH
+        self.sendqueue = None
+        # called with each raw line received, if set
+        self.onrecv = None
         self.lock = threading.RLock()
         self.recvlock = threading.RLock()
 
@@ -123,12 +352,35 @@ class IRCConnection:
             raise e
 
         self.nick = None
-        self.recvbuf = b''
+        self.recvbuf = bytearray()
+        self.recvscan = 0
         self.sendbuf = b''
         self.lock.release()
 
+    def throttle(self, rate=2, burst=5):
+        '''Send lines through a SendQueue that allows 'burst' lines at once and 'rate' lines per second after that.\nquote() and the commands using it will return immediately.'''
+        self.acquire_lock()
+        try:
+            self.stop_sendqueue()
+            self.sendqueue = SendQueue(self, rate, burst)
+            self.sendqueue.start()
+        finally:
+            self.lock.release()
+
+    def stop_sendqueue(self):
+        if self.sendqueue:
+            self.sendqueue.stop()
+            self.sendqueue = None
+
     def quote(self, s, sendnow=True):
         '''Send a raw IRC command. Split multiple commands using \\n.'''
+        sendqueue = self.sendqueue
+        if sendnow and sendqueue:
+            for i in s.splitlines():
+                if i:
+                    sendqueue.put(i.encode('utf-8', 'replace') + b'\r\n', SEND_PRIORITY.get(
+                        i.split(' ', 1)[0].upper(), DEFAULT_SEND_PRIORITY))
+            return
         tmpbuf = b''
         for i in s.splitlines():
             if i:
@@ -139,6 +391,21 @@ class IRCConnection:
             else:
                 self.sendbuf += tmpbuf
 
+    def quotelines(self, lines, sendnow=True, priority=None):
+        '''Send a list of non-empty raw IRC commands without line breaks.\nThe send queue priority is looked up from the command if not given.'''
+        sendqueue = self.sendqueue
+        if sendnow and sendqueue:
+            for i in lines:
+                sendqueue.put(i.encode('utf-8', 'replace') + b'\r\n', SEND_PRIORITY.get(
+                    i.split(' ', 1)[0].upper(), DEFAULT_SEND_PRIORITY) if priority is None else priority)
+            return
+        if lines:
+            tmpbuf = ('\r\n'.join(lines) + '\r\n').encode('utf-8', 'replace')
+            if sendnow:
+                self.send(tmpbuf)
+            else:
+                self.sendbuf += tmpbuf
+
     def send(self, sendbuf=None):
         '''Flush the send buffer.'''
         self.acquire_lock()
@@ -157,6 +424,7 @@ class IRCConnection:
                     self.sock.sendall(sendbuf)
             except socket.error as e:
                 try:
+                    self.stop_sendqueue()
                     self.sock.close()
                 finally:
                     self.sock = None
@@ -209,6 +477,7 @@ class IRCConnection:
             reason = ''
         self.acquire_lock()
         try:
+            self.stop_sendqueue()
             if self.sock:
                 try:
                     if wait:
@@ -232,10 +501,9 @@ class IRCConnection:
 
     def say(self, dest, msg, sendnow=True):
         '''Send a message to a channel, or a private message to a person.'''
-        tmpbuf = ''
-        for i in msg.splitlines():
-            tmpbuf += 'PRIVMSG %s :%s\n' % (catchannel(dest), rmcr(i))
-        self.quote(tmpbuf, sendnow=sendnow)
+        prefix = 'PRIVMSG %s :' % catchannel(dest)
+        # splitlines() leaves no \r
+        self.quotelines([prefix + i for i in msg.splitlines()], sendnow, DEFAULT_SEND_PRIORITY)
 
     def me(self, dest, action, sendnow=True):
         '''Send an action message.'''
@@ -334,6 +602,9 @@ class IRCConnection:
                             del oldtimeout
                     if received:
                         self.recvbuf += received
+                        # the kernel had more for us, read bigger chunks
+                        if len(received) == self.buffer_length and self.buffer_length < MAX_BUFFER_LENGTH:
+                            self.buffer_length *= 2
                     else:
                         self.quit('Connection reset by peer.', wait=False)
                     return True
@@ -364,89 +635,93 @@ class IRCConnection:
             finally:
                 self.recvlock.release()
 
+    def wait(self, timeout=None):
+        '''Wait until there is something to read, or timeout (in seconds) expires.\nReturns True if recvline() can make progress without blocking.'''
+        if self.recvbuf.find(b'\n', self.recvscan) != -1:
+            return True
+        sock = self.sock
+        if not sock:
+            return False
+        if isinstance(sock, ssl.SSLSocket) and sock.pending():
+            return True
+        try:
+            readable = select.select((sock,), (), (), timeout)[0]
+        except (select.error, ValueError):
+            # the socket was closed by another thread
+            return False
+        return bool(readable)
+
     def recvline(self, block=True):
         '''Receive a raw line from server.\nIt calls recv(), and is called by parse() when line==None.\nIts output can be the 'line' argument of parse()'s input.'''
         if self.recvlock.acquire(blocking=block):
             try:
-                while self.recvbuf.find(b'\n') == -1 and self.recv(block):
-                    pass
-                if self.recvbuf.find(b'\n') != -1:
-                    line, self.recvbuf = self.recvbuf.split(b'\n', 1)
-                    return line.rstrip(b'\r').decode('utf-8', 'replace')
-                else:
-                    return None
+                pos = self.recvbuf.find(b'\n', self.recvscan)
+                while pos == -1:
+                    # bytes before recvscan are known to contain no newline
+                    self.recvscan = len(self.recvbuf)
+                    if not self.recv(block):
+                        return None
+                    pos = self.recvbuf.find(b'\n', self.recvscan)
+                end = pos
+                if end and self.recvbuf[end - 1] == 13:
+                    end -= 1
+                line = self.recvbuf[:end].decode('utf-8', 'replace')
+                del self.recvbuf[:pos + 1]
+                self.recvscan = 0
+                if self.onrecv is not None:
+                    self.onrecv(line)
+                return line
             finally:
                 self.recvlock.release()
         else:
             return None
 
+    def recvlines(self, block=True):
+        '''Receive all complete raw lines, calling recv() at most once.\nReturns a list, which is empty if no complete line has arrived yet.'''
+        if not self.recvlock.acquire(blocking=block):
+            return []
+        try:
+            if self.recvbuf.find(b'\n', self.recvscan) == -1:
+                self.recvscan = len(self.recvbuf)
+                self.recv(block)
+            end = self.recvbuf.rfind(b'\n')
+            if end < self.recvscan:
+                self.recvscan = len(self.recvbuf)
+                return []
+            data = self.recvbuf[:end].decode('utf-8', 'replace')
+            del self.recvbuf[:end + 1]
+            self.recvscan = 0
+            lines = [line.rstrip('\r') for line in data.split('\n')]
+            if self.onrecv is not None:
+                for line in lines:
+                    self.onrecv(line)
+            return lines
+        finally:
+            self.recvlock.release()
+
     def parse(self, block=True, line=None):
-        '''Receive messages from server and process it.\nReturning a dictionary or None.\nIts 'line' argument accepts the output of recvline().'''
+        '''Receive messages from server and process it.\nReturning an IRCMessage or None.\nIts 'line' argument accepts the output of recvline().'''
         if line is None:
             line = self.recvline(block)
-        if line:
-            try:
-                if line.startswith('PING '):
-                    try:
-                        self.quote('PONG %s' % line[5:], sendnow=True)
-                    finally:
-                        return {'nick': None, 'ident': None, 'cmd': 'PING', 'dest': None, 'msg': stripcomma(line[5:])}
-                if line.startswith(':'):
-                    cmd = line.split(' ', 1)
-                    nick = cmd.pop(0).split('!', 1)
-                    if len(nick) >= 2:
-                        nick, ident = nick
-                    else:
-                        ident = None
-                        nick = nick[0]
-                    nick = stripcomma(nick)
-                else:
-                    nick = None
-                    ident = None
-                    if line == "":
-                        cmd = []
-                    else:
-                        cmd = [line]
-                if cmd != []:
-                    msg = cmd[0].split(' ', 1)
-                    cmd = msg.pop(0)
-                    if msg != []:
-                        if msg[0].startswith(':'):
-                            dest = None
-                            msg = stripcomma(msg[0])
-                        else:
-                            msg = msg[0].split(' ', 1)
-                            dest = msg.pop(0)
-                            if cmd != 'KICK':
-                                if msg != []:
-                                    msg = stripcomma(msg[0])
-                                else:
-                                    msg = None
-                            else:
-                                if msg != []:
-                                    msg = msg[0].split(' ', 1)
-                                    dest2 = msg.pop(0)
-                                    if msg != []:
-                                        msg = stripcomma(msg[0])
-                                    else:
-                                        msg = None
-                                    dest = (dest, dest2)
-                                else:
-                                    msg = None
-                                    dest = (None, dest)
-                    else:
-                        msg = dest = None
-                else:
-                    msg = dest = cmd = None
-                try:
-                    if nick and cmd == 'PRIVMSG' and msg and tostr(msg).startswith('\x01PING '):
-                        self.notice(tostr(nick), tostr(msg), sendnow=True)
-                finally:
-                    return {'nick': nick, 'ident': ident, 'cmd': cmd, 'dest': dest, 'msg': msg}
-            except:
-                return {'nick': None, 'ident': None, 'cmd': None, 'dest': None, 'msg': line}
-        else:
+        if not line:
             return None
+        msg = parse_line(line)
+        self.autoreply(msg)
+        return msg
+
+    def parse_many(self, lines):
+        '''Process a list of raw lines, eg. the output of recvlines().\nReturning a list of IRCMessage.'''
+        msgs = parse_many(lines)
+        for msg in msgs:
+            self.autoreply(msg)
+        return msgs
+
+    def autoreply(self, msg):
+        '''Answer server PINGs and CTCP PINGs.'''
+        if msg.cmd == 'PING':
+            self.quote('PONG :%s' % (msg.msg or ''), sendnow=True)
+        elif msg.cmd == 'PRIVMSG' and msg.nick and msg.msg and msg.msg.startswith('\x01PING '):
+            self.notice(msg.nick, msg.msg, sendnow=True)
 
     def __del__(self):
         if self.sock:
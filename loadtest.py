@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+
+'''
+End-to-end load test of relay.py against a fake Bot API and a fake IRC
+server on localhost, without network access.
+
+Run: python3 loadtest.py [-n MESSAGES] [-r RATE] [--set key=value ...]
+
+Each message carries a token, and its latency is measured from when it
+is handed to the fake server on one side until the relay delivers it to
+the fake server on the other side.
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.server
+import socketserver
+import urllib.parse
+import collections
+
+RELAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'relay.py')
+
+TOKEN = '123456789:LOADTEST'
+BOT_ID = 123456789
+IRCBOT_ID = 987654321
+GROUP_ID = 1001
+CHAT_ID = -GROUP_ID
+CHANNEL = '#loadtest'
+PHOTO = b'\xff\xd8\xff\xe0' + bytes(range(256)) * 64
+
+TG_KINDS = ('text', 'reply', 'forward', 'photo')
+IRC_KINDS = ('text', 'action')
+
+re_token = re.compile(r'\blt(\d+)x\b')
+
+
+class Recorder:
+    '''Send and delivery times of tokens.'''
+
+    def __init__(self):
+        self.sent = {}
+        self.latency = collections.defaultdict(list)
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.first = self.last = None
+
+    def send(self, token, kind):
+        now = time.perf_counter()
+        with self.lock:
+            self.sent[token] = (kind, now)
+            self.counts[kind] += 1
+            if self.first is None:
+                self.first = now
+
+    def receive(self, text):
+        now = time.perf_counter()
+        with self.lock:
+            for token in re_token.findall(text):
+                item = self.sent.pop(int(token), None)
+                if item is not None:
+                    self.latency[item[0]].append(now - item[1])
+                    self.last = now
+
+    def pending(self):
+        return len(self.sent)
+
+
+class FakeBotAPI(http.server.ThreadingHTTPServer):
+    '''Enough of the Bot API for relay.py: polling, sending and files.'''
+
+    daemon_threads = True
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.updates = []
+        self.update_id = 0
+        self.message_id = 0
+        self.cond = threading.Condition()
+        self.polled = threading.Event()
+        self.last_sent = None
+        self.calls = collections.Counter()
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), BotAPIHandler)
+
+    def next_message_id(self):
+        with self.cond:
+            self.message_id += 1
+            return self.message_id
+
+    def put(self, msg):
+        with self.cond:
+            self.update_id += 1
+            self.updates.append({'update_id': self.update_id, 'message': msg})
+            self.cond.notify_all()
+
+    def get_updates(self, offset, timeout, limit):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.updates[:limit]
+
+
+class BotAPIHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.split('/')
+        if path[1:3] == ['file', 'bot' + TOKEN]:
+            server.calls['download'] += 1
+            self.reply(PHOTO, 'image/jpeg')
+            return
+        if len(path) != 3 or path[1] != 'bot' + TOKEN:
+            self.send_error(404)
+            return
+        method = path[2]
+        params = dict(urllib.parse.parse_qsl(url.query))
+        server.calls[method] += 1
+        if method == 'getMe':
+            result = {'id': BOT_ID, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'LoadTestBot'}
+        elif method in ('deleteWebhook', 'sendChatAction'):
+            result = True
+        elif method == 'getUpdates':
+            server.polled.set()
+            result = server.get_updates(int(params.get('offset', 0)),
+                min(float(params.get('timeout', 0)), 5), int(params.get('limit', 100)))
+        elif method == 'sendMessage':
+            server.recorder.receive(params.get('text', ''))
+            result = {
+                'message_id': server.next_message_id(),
+                'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'LoadTestBot'},
+                'chat': {'id': int(params['chat_id']), 'type': 'supergroup'},
+                'date': int(time.time()),
+                'text': params.get('text', ''),
+            }
+            server.last_sent = result
+        elif method == 'getFile':
+            result = {'file_id': params['file_id'], 'file_size': len(PHOTO),
+                      'file_path': 'photos/%s.jpg' % params['file_id']}
+        else:
+            self.reply(json.dumps({'ok': False, 'error_code': 404,
+                'description': 'Not Found'}).encode('utf-8'), 'application/json', 404)
+            return
+        self.reply(json.dumps({'ok': True, 'result': result}).encode('utf-8'), 'application/json')
+
+    def reply(self, body, ctype, code=200):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeIRCd(socketserver.ThreadingTCPServer):
+    '''An IRC server with one channel that records what the relay says.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.client = None
+        self.lock = threading.Lock()
+        self.joined = threading.Event()
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), IRCHandler)
+
+    def inject(self, line):
+        with self.lock:
+            if self.client is not None:
+                self.client.sendall(line.encode('utf-8') + b'\r\n')
+
+
+class IRCHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        nick = None
+        # lines are injected one by one, don't let Nagle hold them back
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with server.lock:
+            server.client = self.request
+        for raw in self.rfile:
+            line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+            cmd, _, args = line.partition(' ')
+            cmd = cmd.upper()
+            if cmd == 'NICK':
+                nick = args.strip()
+                server.inject(':fake.ircd 001 %s :Welcome' % nick)
+            elif cmd == 'JOIN':
+                for channel in args.split(' ')[0].split(','):
+                    server.inject(':%s!~relay@localhost JOIN %s' % (nick, channel))
+                server.joined.set()
+            elif cmd == 'PING':
+                server.inject(':fake.ircd PONG fake.ircd %s' % args)
+            elif cmd in ('PRIVMSG', 'NOTICE'):
+                server.recorder.receive(args.partition(' :')[2])
+        with server.lock:
+            if server.client is self.request:
+                server.client = None
+
+
+def serve(server):
+    thr = threading.Thread(target=server.serve_forever)
+    thr.daemon = True
+    thr.start()
+    return server
+
+
+def tg_message(api, token, kind):
+    text = 'lt%dx message from Telegram' % token
+    msg = {
+        'message_id': api.next_message_id(),
+        'from': {'id': 1000 + token % 7, 'is_bot': False, 'first_name': 'User%d' % (token % 7)},
+        'chat': {'id': CHAT_ID, 'type': 'supergroup', 'title': 'Load Test'},
+        'date': int(time.time()),
+    }
+    if kind == 'photo':
+        file_id = 'photo%d' % token
+        msg['photo'] = [{'file_id': file_id, 'width': 320, 'height': 240, 'file_size': len(PHOTO)}]
+        msg['caption'] = text
+    else:
+        msg['text'] = text
+    if kind == 'reply' and api.last_sent is not None:
+        msg['reply_to_message'] = api.last_sent
+    elif kind == 'forward':
+        msg['forward_from'] = {'id': 4242, 'is_bot': False, 'first_name': 'Someone'}
+        msg['forward_date'] = int(time.time()) - 60
+    return msg
+
+
+def irc_line(token, kind):
+    text = 'lt%dx message from IRC' % token
+    if kind == 'action':
+        text = '\x01ACTION %s\x01' % text
+    return ':nick%d!~user@irc.example.com PRIVMSG %s :%s' % (token % 7, CHANNEL, text)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))] if values else float('nan')
+
+
+def report(recorder, elapsed):
+    print('%-14s %7s %7s %7s %9s %9s' % ('kind', 'sent', 'recv', 'lost', 'p50 ms', 'p99 ms'))
+    total = 0
+    for kind in sorted(recorder.counts):
+        lat = recorder.latency[kind]
+        total += len(lat)
+        print('%-14s %7d %7d %7d %9.2f %9.2f' % (kind, recorder.counts[kind], len(lat),
+            recorder.counts[kind] - len(lat), percentile(lat, .5) * 1000, percentile(lat, .99) * 1000))
+    alllat = [v for lat in recorder.latency.values() for v in lat]
+    print('%-14s %7d %7d %7d %9.2f %9.2f' % ('all', sum(recorder.counts.values()), total,
+        recorder.pending(), percentile(alllat, .5) * 1000, percentile(alllat, .99) * 1000))
+    print('throughput: %.1f messages/s over %.2fs' % (total / elapsed if elapsed else 0, elapsed))
+
+
+def irc_latency(count, limit):
+    '''
+    Latency of the IRC reader alone: from a line sent by FakeIRCd until
+    IRCConnection.wait() and recvlines() hand it over, as in getircupd().
+    Returns 1 if the p99 is over `limit` seconds.
+    '''
+    sys.path.insert(0, os.path.dirname(RELAY))
+    import libirc
+    recorder = Recorder()
+    ircd = serve(FakeIRCd(recorder))
+    conn = libirc.IRCConnection()
+    conn.connect(ircd.server_address)
+    conn.setnick('latency')
+    conn.setuser('latency', 'latency')
+    conn.join(CHANNEL)
+    if not ircd.joined.wait(10):
+        print('could not join the fake IRC server')
+        return 1
+
+    def reader():
+        while conn.sock:
+            if conn.wait(1):
+                for line in conn.recvlines(block=False):
+                    recorder.receive(line)
+
+    thr = threading.Thread(target=reader)
+    thr.daemon = True
+    thr.start()
+    for token in range(count):
+        recorder.send(token, 'irc-read')
+        ircd.inject(irc_line(token, 'text'))
+        # one line at a time, so each waits for the reader to wake up
+        time.sleep(.002)
+    deadline = time.monotonic() + 5
+    while recorder.pending() and time.monotonic() < deadline:
+        time.sleep(.01)
+    lat = recorder.latency['irc-read']
+    p99 = percentile(lat, .99)
+    print('IRC reader: %d/%d lines, p50 %.2f ms, p99 %.2f ms (limit %.0f ms)' % (
+        len(lat), count, percentile(lat, .5) * 1000, p99 * 1000, limit * 1000))
+    conn.quit(wait=False)
+    ircd.shutdown()
+    return 0 if len(lat) == count and p99 <= limit else 1
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load test of relay.py.')
+    parser.add_argument('-n', '--messages', type=int, default=1000, help='messages to send (default: 1000)')
+    parser.add_argument('-r', '--rate', type=float, default=200, help='messages per second, 0 for no pacing (default: 200)')
+    parser.add_argument('--tg-share', type=float, default=.5, help='fraction sent from Telegram (default: 0.5)')
+    parser.add_argument('--tg-kinds', default=','.join(TG_KINDS), help='kinds of Telegram messages (default: %(default)s)')
+    parser.add_argument('--irc-kinds', default=','.join(IRC_KINDS), help='kinds of IRC messages (default: %(default)s)')
+    parser.add_argument('--drain', type=float, default=15, help='seconds to wait for the last deliveries (default: 15)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the traffic mix')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='override a relay config option, VALUE is parsed as JSON if possible')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory with the relay log')
+    parser.add_argument('--irc-latency', type=int, metavar='LINES',
+                        help='only check the latency of the IRC reader with this many lines, fail over --irc-limit')
+    parser.add_argument('--irc-limit', type=float, default=50, help='p99 limit of --irc-latency in ms (default: 50)')
+    args = parser.parse_args()
+    if args.irc_latency:
+        return irc_latency(args.irc_latency, args.irc_limit / 1000)
+
+    recorder = Recorder()
+    api = serve(FakeBotAPI(recorder))
+    ircd = serve(FakeIRCd(recorder))
+    workdir = tempfile.mkdtemp(prefix='relay-loadtest-')
+    os.mkdir(os.path.join(workdir, 'cache'))
+    cfg = {
+        'token': TOKEN,
+        'apiurl': 'http://127.0.0.1:%d/' % api.server_address[1],
+        'botid': BOT_ID,
+        'botname': 'LoadTestBot',
+        'groupid': GROUP_ID,
+        'groupname': 'Load Test',
+        'ircchannel': CHANNEL,
+        'i2t': True,
+        't2i': True,
+        'ircignore': 'IgnoredBot',
+        'ircbotid': IRCBOT_ID,
+        'ircbotname': 'IRC',
+        'ircnick': 'relaybot',
+        'ircpass': '',
+        'ircserver': '127.0.0.1',
+        'ircport': ircd.server_address[1],
+        'ircssl': False,
+        'offset': 0,
+        'polltimeout': 5,
+        'servemedia': 'self',
+        'serveurl': 'http://media.invalid/',
+        'cachepath': os.path.join(workdir, 'cache'),
+        # measure the relay, not the flood control
+        'ircrate': 100000,
+        'ircburst': 100000,
+        'tgrate': 100000,
+        'tgchatrate': 6000000,
+        'tgchatburst': 100000,
+    }
+    for item in args.set:
+        key, _, value = item.partition('=')
+        cfg[key] = parse_value(value)
+    with open(os.path.join(workdir, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(cfg, f, indent=4)
+
+    log = open(os.path.join(workdir, 'relay.log'), 'wb')
+    proc = subprocess.Popen([sys.executable, RELAY], cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        if not (ircd.joined.wait(30) and api.polled.wait(30)):
+            print('relay did not start, see %s' % log.name)
+            return 1
+        rnd = random.Random(args.seed)
+        tg_kinds = args.tg_kinds.split(',')
+        irc_kinds = args.irc_kinds.split(',')
+        interval = 1 / args.rate if args.rate else 0
+        start = time.perf_counter()
+        for token in range(args.messages):
+            if rnd.random() < args.tg_share:
+                kind = rnd.choice(tg_kinds)
+                msg = tg_message(api, token, kind)
+                recorder.send(token, 'tg-' + kind)
+                api.put(msg)
+            else:
+                kind = rnd.choice(irc_kinds)
+                line = irc_line(token, kind)
+                recorder.send(token, 'irc-' + kind)
+                ircd.inject(line)
+            if interval:
+                delay = start + (token + 1) * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        deadline = time.monotonic() + args.drain
+        while recorder.pending() and time.monotonic() < deadline:
+            time.sleep(.05)
+        report(recorder, (recorder.last or start) - (recorder.first or start))
+        print('bot api calls: %s' % ', '.join('%s %d' % kv for kv in sorted(api.calls.items())))
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+        if args.keep:
+            print('relay log and state: %s' % workdir)
+        else:
+            shutil.rmtree(workdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
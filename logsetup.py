@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Logging through a queue, so that threads never wait for log output.'''
+
+import sys
+import copy
+import json
+import queue
+import logging
+import logging.handlers
+
+__all__ = ['JSONFormatter', 'setup']
+
+FORMAT = '# %(asctime)s [%(levelname)s] %(message)s'
+
+
+class JSONFormatter(logging.Formatter):
+    '''One JSON object per line, with the logger name and thread.'''
+
+    def format(self, record):
+        ret = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            ret['exc'] = record.exc_text
+        return json.dumps(ret, ensure_ascii=False)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    '''
+    Puts records on the queue with the message and traceback rendered,
+    but leaves the rest of the formatting to the listener thread.
+    '''
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # the frames may change after this returns
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup(level=logging.INFO, json_lines=False, levels=None, stream=sys.stdout):
+    '''
+    Send the log records of all loggers to a background thread writing
+    to stream, as text or JSON lines. `levels` maps logger names to
+    levels, eg. {"relay.irc": "DEBUG"}.
+    Returns the QueueListener, stop() it to flush the log on exit.
+    '''
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JSONFormatter() if json_lines else logging.Formatter(FORMAT))
+    q = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(QueueHandler(q))
+    for name, lvl in (levels or {}).items():
+        logging.getLogger(name).setLevel(lvl.upper() if isinstance(lvl, str) else lvl)
+    listener = logging.handlers.QueueListener(q, handler)
+    listener.start()
+    return listener
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''A thread-safe LRU cache with optional expiry and size limit.'''
+
+import sys
+import time
+import threading
+import collections
+
+__all__ = ['LRUCache']
+
+_MISSING = object()
+
+
+class LRUCache:
+    '''
+    A mapping of at most `maxlen` items, dropping the least recently used
+    ones first. Items also expire `ttl` seconds after they were set, and
+    when `maxbytes` is given, items are dropped until the total of
+    sizeof(value) fits in it. Zero disables either limit.
+
+    Writes take a lock. Reads don't: a lookup in the OrderedDict is atomic,
+    and the item is only moved to the recent end if the lock is free, so
+    the order is approximate under contention. The counters are likewise
+    approximate.
+    '''
+
+    def __init__(self, maxlen, ttl=0, maxbytes=0, sizeof=sys.getsizeof):
+        self.capacity = maxlen
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        # key -> (value, expiry time or 0, size)
+        self.cache = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        item = self.cache.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        if item[1] and item[1] < time.monotonic():
+            with self.lock:
+                if self.cache.get(key) is item:
+                    del self.cache[key]
+                    self.size -= item[2]
+                    self.expirations += 1
+            self.misses += 1
+            return default
+        self.hits += 1
+        if self.lock.acquire(False):
+            try:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+            finally:
+                self.lock.release()
+        return item[0]
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) if self.maxbytes else 0
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        with self.lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.cache[key] = (value, expires, size)
+            self.size += size
+            while len(self.cache) > self.capacity or (
+                    self.maxbytes and self.size > self.maxbytes and len(self.cache) > 1):
+                item = self.cache.popitem(last=False)[1]
+                self.size -= item[2]
+                self.evictions += 1
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self.cache)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'items': len(self.cache),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitrate': self.hits / lookups if lookups else 0.,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
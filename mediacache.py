@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''An in-memory index of the media cache directory, with size and age limits.'''
+
+import os
+import time
+import logging
+import threading
+import collections
+
+__all__ = ['MediaCache']
+
+LOG = logging.getLogger(__name__)
+
+# suffix of files being downloaded
+PARTIAL_SUFFIX = '.part'
+
+
+class MediaCache:
+    '''
+    Index of the files in `path`: name -> [size, last access], least
+    recently used first. It is built by one directory scan on start, then
+    kept up to date by add(), so lookup() never touches the filesystem.
+
+    Files are removed, least recently used first, when the total size is
+    over `maxbytes` or they haven't been used for `ttl` seconds. Zero
+    disables either limit.
+
+    Downloads in progress are in `pending`: name -> expected size or None.
+    '''
+
+    def __init__(self, path, maxbytes=0, ttl=0):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.files = collections.OrderedDict()
+        self.pending = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.scan()
+        if ttl:
+            thr = threading.Thread(target=self.run, name='MediaCache')
+            thr.daemon = True
+            thr.start()
+
+    def scan(self):
+        files = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith(PARTIAL_SUFFIX):
+                    # left over from an interrupted download
+                    os.unlink(entry.path)
+                    continue
+                st = entry.stat()
+                files.append((max(st.st_atime, st.st_mtime), entry.name, st.st_size))
+        files.sort()
+        with self.lock:
+            self.files.clear()
+            self.size = 0
+            for atime, name, size in files:
+                self.files[name] = [size, atime]
+                self.size += size
+        self.evict()
+        LOG.info('Media cache: %d files, %d bytes.', len(self.files), self.size)
+
+    def lookup(self, name, size=None):
+        '''Returns True if the file is cached (with the size, if given), and marks it used.'''
+        with self.lock:
+            item = self.files.get(name)
+            if item is None or (size is not None and item[0] != size):
+                self.misses += 1
+                return False
+            item[1] = time.time()
+            self.files.move_to_end(name)
+            self.hits += 1
+            return True
+
+    def touch(self, name):
+        '''Mark the file used without counting a lookup.'''
+        with self.lock:
+            item = self.files.get(name)
+            if item is not None:
+                item[1] = time.time()
+                self.files.move_to_end(name)
+
+    def begin(self, name, size=None):
+        '''Record that the file is being downloaded to name + PARTIAL_SUFFIX.'''
+        self.pending[name] = size
+
+    def end(self, name):
+        '''Record that a download finished or failed.'''
+        self.pending.pop(name, None)
+
+    def add(self, name, size):
+        '''Record a file just written to the cache directory.'''
+        with self.lock:
+            item = self.files.pop(name, None)
+            if item is not None:
+                self.size -= item[0]
+            self.files[name] = [size, time.time()]
+            self.size += size
+        self.evict()
+
+    def evict(self):
+        '''Remove expired files and the least recently used ones over the size limit.'''
+        removed = []
+        with self.lock:
+            deadline = time.time() - self.ttl
+            while self.files:
+                name, (size, atime) = next(iter(self.files.items()))
+                if (self.ttl and atime < deadline) or (self.maxbytes and self.size > self.maxbytes):
+                    del self.files[name]
+                    self.size -= size
+                    self.evictions += 1
+                    removed.append(name)
+                else:
+                    break
+        for name in removed:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def run(self):
+        while 1:
+            time.sleep(min(self.ttl / 10, 600))
+            try:
+                self.evict()
+            except Exception:
+                LOG.exception('Media cache eviction failed.')
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'files': len(self.files),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitrate': self.hits / lookups if lookups else 0.,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''A static file server for the media cache.'''
+
+import os
+import re
+import time
+import logging
+import mimetypes
+import threading
+import email.utils
+import http.server
+import urllib.parse
+
+from mediacache import PARTIAL_SUFFIX
+
+__all__ = ['MediaServer', 'serve']
+
+LOG = logging.getLogger(__name__)
+
+re_range = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# how long to wait for more data of a file being downloaded
+TAIL_INTERVAL = 0.05
+TAIL_TIMEOUT = 60
+
+
+class MediaHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serve files of the media cache with sendfile(), supporting Range and
+    conditional requests. A file still being downloaded is sent as it
+    grows.
+    '''
+
+    server_version = 'TgIRCRelayMedia'
+
+    def do_GET(self):
+        self.serve(True)
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def serve(self, body):
+        name = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/')
+        if not name or '/' in name or name.startswith('.') or name.endswith(PARTIAL_SUFFIX):
+            self.send_error(404)
+            return
+        cache = self.server.cache
+        fpath = os.path.join(cache.path, name)
+        try:
+            f = open(fpath, 'rb')
+        except FileNotFoundError:
+            f = self.open_partial(name, fpath)
+            if f is None:
+                self.send_error(404)
+                return
+            with f:
+                self.send_partial(name, f, body)
+            return
+        with f:
+            cache.touch(name)
+            self.send_file(name, f, body)
+
+    def open_partial(self, name, fpath):
+        '''Open the file being downloaded, or return None if there is none.'''
+        deadline = time.monotonic() + TAIL_TIMEOUT
+        while name in self.server.cache.pending and time.monotonic() < deadline:
+            try:
+                return open(fpath + PARTIAL_SUFFIX, 'rb')
+            except FileNotFoundError:
+                pass
+            # renamed in the meantime
+            try:
+                return open(fpath, 'rb')
+            except FileNotFoundError:
+                time.sleep(TAIL_INTERVAL)
+        # the download may have finished while sleeping
+        try:
+            return open(fpath, 'rb')
+        except FileNotFoundError:
+            return None
+
+    def send_file(self, name, f, body):
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        etag = '"%x-%x"' % (st.st_mtime_ns, size)
+        lastmod = email.utils.formatdate(st.st_mtime, usegmt=True)
+        if self.not_modified(etag, st.st_mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', lastmod)
+            self.end_headers()
+            return
+        start, end = 0, size - 1
+        status = 200
+        rangehdr = self.headers.get('Range')
+        if rangehdr and size and self.headers.get('If-Range', etag) in (etag, lastmod):
+            match = re_range.match(rangehdr.strip())
+            if match and any(match.groups()):
+                first, last = match.groups()
+                if first:
+                    start = int(first)
+                    end = min(int(last), size - 1) if last else size - 1
+                else:
+                    start = max(size - int(last), 0)
+                if start > end or start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', self.guess_type(name))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', lastmod)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+        if body and end >= start:
+            self.connection.sendfile(f, start, end - start + 1)
+
+    def send_partial(self, name, f, body):
+        expected = self.server.cache.pending.get(name)
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(name))
+        if expected:
+            self.send_header('Content-Length', str(expected))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        if not body:
+            return
+        offset = 0
+        idle = time.monotonic()
+        while 1:
+            available = os.fstat(f.fileno()).st_size - offset
+            if available > 0:
+                offset += self.connection.sendfile(f, offset, available)
+                idle = time.monotonic()
+            elif expected and offset >= expected:
+                return
+            elif name not in self.server.cache.pending:
+                # finished or failed, send what is left
+                available = os.fstat(f.fileno()).st_size - offset
+                if available > 0:
+                    self.connection.sendfile(f, offset, available)
+                return
+            elif time.monotonic() - idle > TAIL_TIMEOUT:
+                return
+            else:
+                time.sleep(TAIL_INTERVAL)
+
+    def not_modified(self, etag, mtime):
+        inm = self.headers.get('If-None-Match')
+        if inm is not None:
+            return inm.strip() == '*' or etag in (t.strip() for t in inm.split(','))
+        ims = self.headers.get('If-Modified-Since')
+        if ims is not None:
+            try:
+                return int(mtime) <= email.utils.parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def guess_type(self, name):
+        return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    def log_message(self, format, *args):
+        LOG.debug('Media server: ' + format, *args)
+
+
+class MediaServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, cache):
+        self.cache = cache
+        http.server.ThreadingHTTPServer.__init__(self, addr, MediaHandler)
+
+
+def serve(addr, cache):
+    '''Start a MediaServer of a MediaCache in a background thread.'''
+    server = MediaServer(addr, cache)
+    thr = threading.Thread(target=server.serve_forever, name='MediaServer')
+    thr.daemon = True
+    thr.start()
+    return server
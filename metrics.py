@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Counters and latency histograms, exported in the Prometheus text format.'''
+
+import bisect
+import logging
+import threading
+import http.server
+
+__all__ = ['Counter', 'Histogram', 'counter', 'histogram', 'collect', 'collect_stats', 'render', 'summary', 'serve']
+
+LOG = logging.getLogger(__name__)
+
+# seconds, from a fast function call to a slow HTTP request
+DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+                   .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter:
+    '''
+    A number that only goes up. inc() takes no lock: under the GIL a
+    concurrent increment is lost only rarely, which is fine for metrics.
+    '''
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Histogram:
+    '''Counts of observed values by bucket upper bound, with their sum.'''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''Estimate the q-quantile as the upper bound of its bucket.'''
+        if not self.count:
+            return 0.
+        rank = q * self.count
+        total = 0
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class Family:
+    '''Metrics of the same name, one per combination of label values.'''
+
+    def __init__(self, name, kind, help, labelnames, factory):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelnames = labelnames
+        self.factory = factory
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            labels = dict(zip(self.labelnames, values))
+            if self.kind == 'counter':
+                yield self.name, labels, child.value
+            else:
+                total = 0
+                for bound, n in zip(child.buckets + ('+Inf',), child.counts):
+                    total += n
+                    yield self.name + '_bucket', dict(labels, le=str(bound)), total
+                yield self.name + '_sum', labels, child.sum
+                yield self.name + '_count', labels, child.count
+
+
+class Collector:
+    '''
+    Samples read from func() at export time, for numbers that are
+    already kept elsewhere. func returns a number, or a dict of label
+    value (or tuple of them) -> number.
+    '''
+
+    def __init__(self, name, kind, help, labelnames, func):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelnames = labelnames
+        self.func = func
+
+    def samples(self):
+        ret = self.func()
+        if not isinstance(ret, dict):
+            yield self.name, {}, ret
+            return
+        for values, value in ret.items():
+            if not isinstance(values, tuple):
+                values = (values,)
+            yield self.name, dict(zip(self.labelnames, values)), value
+
+
+REGISTRY = []
+
+
+def counter(name, help, labelnames=()):
+    '''Register a counter. Returns a Counter, or its family if it has labels.'''
+    family = Family(name, 'counter', help, tuple(labelnames), Counter)
+    REGISTRY.append(family)
+    return family if labelnames else family.labels()
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    '''Register a histogram. Returns a Histogram, or its family if it has labels.'''
+    family = Family(name, 'histogram', help, tuple(labelnames), lambda: Histogram(buckets))
+    REGISTRY.append(family)
+    return family if labelnames else family.labels()
+
+
+def collect(name, help, func, labelnames=(), kind='gauge'):
+    REGISTRY.append(Collector(name, kind, help, tuple(labelnames), func))
+
+
+def collect_stats(name, help, func, counters, labelnames=('stat',)):
+    '''
+    Register func, which returns a dict like the stats() methods, as two
+    metrics: the keys in `counters` as the counter name_total, the others
+    as the gauge name. With several label names, the last one is the key.
+    '''
+    counters = frozenset(counters)
+
+    def pick(counter):
+        def collect():
+            return {k: v for k, v in func().items()
+                    if ((k[-1] if isinstance(k, tuple) else k) in counters) == counter}
+        return collect
+
+    collect(name + '_total', help, pick(True), labelnames, 'counter')
+    collect(name, help, pick(False), labelnames)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render():
+    '''Returns all metrics in the Prometheus text format.'''
+    lines = []
+    for metric in REGISTRY:
+        try:
+            samples = list(metric.samples())
+        except Exception:
+            LOG.exception('Collecting metric %s failed.', metric.name)
+            continue
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for name, labels, value in samples:
+            if labels:
+                name += '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels.items())
+            lines.append('%s %s' % (name, float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    '''Returns one line per counter and histogram, for humans.'''
+    lines = []
+    for metric in REGISTRY:
+        if not isinstance(metric, Family):
+            continue
+        for values, child in sorted(metric.children.items()):
+            name = metric.name
+            if values:
+                name += '{%s}' % ','.join(values)
+            if metric.kind == 'counter':
+                lines.append('%s: %d' % (name, child.value))
+            elif child.count:
+                lines.append('%s: %d, p50 %s, p99 %s' % (name, child.count,
+                    _fmt_seconds(child.quantile(.5)), _fmt_seconds(child.quantile(.99))))
+    return lines
+
+
+def _fmt_seconds(value):
+    if value < 1:
+        return '%gms' % (value * 1000)
+    return '%gs' % value
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug('Metrics: ' + format, *args)
+
+
+def serve(addr):
+    '''Start the /metrics HTTP server in a background thread.'''
+    server = http.server.ThreadingHTTPServer(addr, MetricsHandler)
+    server.daemon_threads = True
+    thr = threading.Thread(target=server.serve_forever, name='Metrics')
+    thr.daemon = True
+    thr.start()
+    return server
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''A bounded, persistent index of relayed messages and their TG<->IRC links.'''
+
+import sqlite3
+import threading
+
+__all__ = ['MessageStore']
+
+USER_FIELDS = ('id', 'first_name', 'last_name', 'username')
+# enough for the reply and forward name matching in relay.py
+TEXT_LIMIT = 256
+PRUNE_EVERY = 1000
+
+
+def compact(msg):
+    '''Keep only the fields needed to resolve replies and forwards.'''
+    user = msg.get('from', {})
+    ret = {'from': {k: user[k] for k in USER_FIELDS if user.get(k) is not None}}
+    if msg.get('text'):
+        ret['text'] = msg['text'][:TEXT_LIMIT]
+    if msg.get('_ircuser'):
+        ret['_ircuser'] = msg['_ircuser']
+    return ret
+
+
+class MessageStore:
+    '''
+    Messages keyed by (chat_id, message_id), with the interface of LRUCache.
+
+    The most recent `hotsize` ones are kept in memory in a `cachecls`
+    (an LRUCache-like class). All of them go into an SQLite database,
+    which is pruned to about `maxrows` rows, so memory use doesn't grow
+    with the number of messages.
+
+    It also links Telegram message ids with the (negative) ids of IRC
+    lines they were relayed from or to, in both directions.
+    '''
+
+    def __init__(self, path, cachecls, maxrows=500000, hotsize=1000):
+        self.hot = cachecls(hotsize)
+        self.hot_tg = cachecls(hotsize)
+        self.hot_irc = cachecls(hotsize)
+        self.maxrows = maxrows
+        self.lock = threading.Lock()
+        self.inserts = 0
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS messages ('
+            'seq INTEGER PRIMARY KEY, '
+            'chat_id INTEGER NOT NULL, '
+            'message_id INTEGER NOT NULL, '
+            'from_id INTEGER, '
+            'first_name TEXT, '
+            'last_name TEXT, '
+            'username TEXT, '
+            'ircuser TEXT, '
+            'text TEXT, '
+            'UNIQUE (chat_id, message_id))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS links ('
+            'chat_id INTEGER NOT NULL, '
+            'tg_id INTEGER NOT NULL, '
+            'irc_id INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS links_tg ON links (chat_id, tg_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS links_irc ON links (chat_id, irc_id)')
+
+    def __setitem__(self, key, msg):
+        msg = compact(msg)
+        user = msg['from']
+        self.hot[key] = msg
+        with self.lock:
+            self.db.execute('REPLACE INTO messages (chat_id, message_id, from_id, '
+                'first_name, last_name, username, ircuser, text) '
+                'VALUES (?,?,?,?,?,?,?,?)', (key[0], key[1], user.get('id'),
+                user.get('first_name'), user.get('last_name'),
+                user.get('username'), msg.get('_ircuser'), msg.get('text')))
+            self.inserts += 1
+            if self.inserts % PRUNE_EVERY == 0:
+                self.prune()
+
+    def get(self, key, default=None):
+        msg = self.hot.get(key)
+        if msg is not None:
+            return msg
+        with self.lock:
+            row = self.db.execute('SELECT from_id, first_name, last_name, '
+                'username, ircuser, text FROM messages '
+                'WHERE chat_id=? AND message_id=?', key).fetchone()
+        if row is None:
+            return default
+        user = {k: v for k, v in zip(USER_FIELDS, row[:4]) if v is not None}
+        msg = {'from': user}
+        if row[4]:
+            msg['_ircuser'] = row[4]
+        if row[5]:
+            msg['text'] = row[5]
+        self.hot[key] = msg
+        return msg
+
+    def __getitem__(self, key):
+        msg = self.get(key)
+        if msg is None:
+            raise KeyError(key)
+        return msg
+
+    def link(self, chat_id, tg_id, irc_id):
+        '''
+        Record that Telegram message tg_id carries IRC line irc_id.
+        One Telegram message may carry many IRC lines, the first one is
+        returned by tg_to_irc().
+        '''
+        if self.hot_tg.get((chat_id, tg_id)) is None:
+            self.hot_tg[(chat_id, tg_id)] = irc_id
+        self.hot_irc[(chat_id, irc_id)] = tg_id
+        with self.lock:
+            self.db.execute('INSERT INTO links VALUES (?,?,?)', (chat_id, tg_id, irc_id))
+
+    def tg_to_irc(self, chat_id, tg_id):
+        '''Returns the IRC line id linked with a Telegram message, or None.'''
+        return self._lookup(self.hot_tg, 'SELECT irc_id FROM links '
+            'WHERE chat_id=? AND tg_id=? ORDER BY rowid', (chat_id, tg_id))
+
+    def irc_to_tg(self, chat_id, irc_id):
+        '''Returns the Telegram message id linked with an IRC line, or None.'''
+        return self._lookup(self.hot_irc, 'SELECT tg_id FROM links '
+            'WHERE chat_id=? AND irc_id=? ORDER BY rowid DESC', (chat_id, irc_id))
+
+    def _lookup(self, hot, sql, key):
+        ret = hot.get(key)
+        if ret is not None:
+            return ret
+        with self.lock:
+            row = self.db.execute(sql, key).fetchone()
+        if row is None:
+            return None
+        hot[key] = row[0]
+        return row[0]
+
+    def prune(self):
+        self.db.execute('DELETE FROM messages WHERE seq <= '
+            '(SELECT max(seq) FROM messages) - ?', (self.maxrows,))
+        self.db.execute('DELETE FROM links WHERE rowid <= '
+            '(SELECT max(rowid) FROM links) - ?', (self.maxrows,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''CPU and memory profilers that can be switched on in a running process.'''
+
+import os
+import sys
+import time
+import threading
+import tracemalloc
+import collections
+
+__all__ = ['SamplingProfiler', 'MemoryProfiler']
+
+
+def _frame_name(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def _cpu_time(ident):
+    '''CPU time used by a thread, or None where it can't be known.'''
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+class SamplingProfiler:
+    '''
+    Sample the stacks of all threads every `interval` seconds from a
+    background thread, with sys._current_frames(). A thread is only
+    sampled if its CPU clock advanced since the last sample, so threads
+    waiting for I/O or locks don't crowd out those doing the work.
+    Where the CPU time of threads is not available, every thread is
+    sampled, which measures wall time.
+
+    Nothing runs while it is stopped.
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # (thread name, code objects from the outermost) -> samples
+        self.samples = collections.Counter()
+        self.count = 0
+        self.started = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        self.samples.clear()
+        self.count = 0
+        self.started = time.monotonic()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='SamplingProfiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        own = threading.get_ident()
+        cputimes = {ident: _cpu_time(ident) for ident in sys._current_frames()}
+        while not self.stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            last, cputimes = cputimes, {}
+            for ident, frame in sys._current_frames().items():
+                cputimes[ident] = cputime = _cpu_time(ident)
+                if ident == own or (cputime is not None and cputime == last.get(ident)):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                self.samples[(names.get(ident, str(ident)), tuple(stack))] += 1
+            self.count += 1
+
+    def write(self, path):
+        '''Write the samples in the folded format of flame graph tools.'''
+        with open(path, 'w', encoding='utf-8') as f:
+            for (name, stack), n in self.samples.most_common():
+                f.write('%s %d\n' % (';'.join([name] + [_frame_name(c) for c in stack]), n))
+
+    def top(self, n=5):
+        '''Returns [(function, share of samples)] of the innermost frames.'''
+        leaves = collections.Counter()
+        for (name, stack), count in self.samples.items():
+            if stack:
+                leaves[_frame_name(stack[-1])] += count
+        total = sum(leaves.values()) or 1
+        return [(name, count / total) for name, count in leaves.most_common(n)]
+
+
+class MemoryProfiler:
+    '''
+    Snapshots of memory allocations with tracemalloc, each one compared
+    with the previous. Tracing, which slows down allocations, only runs
+    between start() and stop().
+    '''
+
+    def __init__(self, frames=10, limit=50):
+        self.frames = frames
+        self.limit = limit
+        self.last = None
+
+    @property
+    def running(self):
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        tracemalloc.start(self.frames)
+        self.last = None
+
+    def stop(self):
+        tracemalloc.stop()
+        self.last = None
+
+    def snapshot(self, path):
+        '''Write the top allocations and the change since the last snapshot. Returns the traced size.'''
+        snap = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),))
+        with open(path, 'w', encoding='utf-8') as f:
+            current, peak = tracemalloc.get_traced_memory()
+            f.write('# traced: %d bytes, peak: %d bytes\n' % (current, peak))
+            f.write('# top %d by size\n' % self.limit)
+            for stat in snap.statistics('lineno')[:self.limit]:
+                f.write('%s\n' % stat)
+            if self.last is not None:
+                f.write('\n# top %d changes since the last snapshot\n' % self.limit)
+                for stat in snap.compare_to(self.last, 'lineno')[:self.limit]:
+                    f.write('%s\n' % stat)
+        self.last = snap
+        return current
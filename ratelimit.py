@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Token bucket rate limiting, shared by the IRC send queue and the Bot API calls.'''
+
+import time
+import threading
+
+__all__ = ['TokenBucket']
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class TokenBucket(object):
+    '''Allow bursts of at most 'burst' tokens, refilled at 'rate' tokens per second.'''
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n=1):
+        '''Take n tokens if available.\nReturns 0 on success, or the seconds to wait before there will be enough tokens.'''
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0
+            return (n - self.tokens) / self.rate
+
+    def wait(self, n=1):
+        '''Block until n tokens are taken. Returns the seconds waited.'''
+        waited = 0
+        while 1:
+            delay = self.consume(n)
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
@@ -16,20 +16,37 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
 import os
 import re
 import sys
 import time
+import ssl
+import uuid
+import signal
 import json
-import queue
+import random
 import socket
 import logging
 import threading
 import functools
 import collections
+import http.server
 import concurrent.futures
 
 import libirc
+import journal
+import capture
+import coalescer
+import dispatcher
+import lrucache
+import logsetup
+import metrics
+import profiler
+import ratelimit
+import msgstore
+import mediacache
+import mediaserver
 import requests
 
 __version__ = '1.2'
@@ -37,56 +54,146 @@ __version__ = '1.2'
 MEDIA_TYPES = frozenset(('audio', 'document', 'photo', 'sticker', 'video', 'voice', 'contact', 'location', 'new_chat_participant', 'left_chat_participant', 'new_chat_title', 'new_chat_photo', 'delete_chat_photo', 'group_chat_created'))
 EXT_MEDIA_TYPES = frozenset(('audio', 'document', 'photo', 'sticker', 'video', 'voice', 'contact', 'location', 'new_chat_participant', 'left_chat_participant', 'new_chat_title', 'new_chat_photo', 'delete_chat_photo', 'group_chat_created', '_ircuser'))
 
-loglevel = logging.DEBUG if sys.argv[-1] == '-d' else logging.INFO
-
-logging.basicConfig(stream=sys.stdout, format='# %(asctime)s [%(levelname)s] %(message)s', level=loglevel)
-
 socket.setdefaulttimeout(60)
 
 HSession = requests.Session()
 USERAGENT = 'TgIRCRelay/%s' % __version__
 HSession.headers["User-Agent"] = USERAGENT
 
+# upper bound of a single wait for IRC socket readability
+IRC_WAIT_TIMEOUT = 30
+
+# length limit of a Telegram message
+TG_MSG_LIMIT = 4096
+
+# read and write media in chunks of this size
+MEDIA_CHUNK = 256 * 1024
+
+API_URL = 'https://api.telegram.org/'
+
+# processmsg() only handles these
+ALLOWED_UPDATES = json.dumps(['message'])
+
 re_ircaction = re.compile('^\x01ACTION (.*)\x01$')
 re_ircforward = re.compile(r'^\[([^]]+)\] (.*)$|^\*\* ([^ ]+) (.*) \*\*$')
 
-class LRUCache:
+class IngestQueue:
+    '''
+    A bounded queue of updates, like queue.Queue. When it is full, put()
+    follows `policy`:
 
-    def __init__(self, maxlen):
-        self.capacity = maxlen
-        self.cache = collections.OrderedDict()
+    - block: wait for room, which slows down the producer
+    - drop: drop the oldest update
+    - collapse: append an IRC line to the newest queued line of the same
+      nick in the same chat, or drop the oldest update if there is none
 
-    def __getitem__(self, key):
-        value = self.cache.pop(key)
-        self.cache[key] = value
-        return value
+    put(upd, block=False) never waits: with the block policy, the update
+    is collapsed as above or else dropped itself. The IRC reader uses it,
+    as it must keep answering PINGs.
 
-    def get(self, key, default=None):
-        try:
-            value = self.cache.pop(key)
-            self.cache[key] = value
-            return value
-        except KeyError:
-            return default
+    put() stores the enqueue time in update['_qtime']. A warning is logged
+    when the length reaches `high` * maxsize, and an info message when it
+    falls back to `low` * maxsize.
+    '''
 
-    def __setitem__(self, key, value):
-        try:
-            self.cache.pop(key)
-        except KeyError:
-            if len(self.cache) >= self.capacity:
-                self.cache.popitem(last=False)
-        self.cache[key] = value
-
-def async_func(func):
-    @functools.wraps(func)
-    def wrapped(*args, **kwargs):
-        def func_noerr(*args, **kwargs):
-            try:
-                func(*args, **kwargs)
-            except Exception:
-                logging.exception('Async function failed.')
-        executor.submit(func_noerr, *args, **kwargs)
-    return wrapped
+    # how far from the tail to look for a line to collapse into
+    COLLAPSE_SCAN = 50
+
+    def __init__(self, maxsize, policy='block', high=0.8, low=0.2):
+        if policy not in ('block', 'drop', 'collapse'):
+            raise ValueError('unknown queue policy: %r' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.high = max(int(maxsize * high), 1)
+        self.low = int(maxsize * low)
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.overloaded = False
+        self.dropped = 0
+        self.collapsed = 0
+        self.wait_total = 0.
+        self.wait_max = 0.
+        self.count = 0
+
+    def put(self, upd, block=True):
+        upd['_qtime'] = time.monotonic()
+        with self.lock:
+            if len(self.queue) >= self.maxsize:
+                if self.policy == 'block' and block:
+                    while len(self.queue) >= self.maxsize:
+                        self.not_full.wait()
+                elif self.policy != 'drop' and self.collapse(upd):
+                    return
+                elif self.policy == 'block':
+                    # the queued updates are waited for, this one isn't
+                    self.dropped += 1
+                    return
+                else:
+                    self.queue.popleft()
+                    self.dropped += 1
+            self.queue.append(upd)
+            if not self.overloaded and len(self.queue) >= self.high:
+                self.overloaded = True
+                TG_LOG.warning('Ingest queue over high watermark: %d updates.', len(self.queue))
+            self.not_empty.notify()
+
+    def collapse(self, upd):
+        msg = upd.get('message', {})
+        nick = msg.get('_ircuser')
+        text = msg.get('text', '')
+        if not nick or text.startswith('\x01'):
+            return False
+        for i in range(len(self.queue) - 1, max(len(self.queue) - self.COLLAPSE_SCAN, 0) - 1, -1):
+            qmsg = self.queue[i].get('message', {})
+            if (qmsg.get('_ircuser') == nick and qmsg['chat']['id'] == msg['chat']['id']
+                    and not qmsg.get('text', '').startswith('\x01')):
+                qmsg['text'] = qmsg.get('text', '') + '\n' + text
+                self.collapsed += 1
+                return True
+        return False
+
+    def get(self):
+        with self.lock:
+            while not self.queue:
+                self.not_empty.wait()
+            upd = self.queue.popleft()
+            if self.overloaded and len(self.queue) <= self.low:
+                self.overloaded = False
+                TG_LOG.info('Ingest queue below low watermark, %d updates dropped, %d collapsed so far.',
+                    self.dropped, self.collapsed)
+            self.not_full.notify()
+        waited = time.monotonic() - upd['_qtime']
+        self.count += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return upd
+
+    def qsize(self):
+        return len(self.queue)
+
+    def stats(self):
+        return {
+            'depth': len(self.queue),
+            'dropped': self.dropped,
+            'collapsed': self.collapsed,
+            'count': self.count,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+        }
+
+def async_func(keyfunc):
+    '''
+    Run the function in DISPATCHER. keyfunc(*args, **kwargs) gives the
+    destination, calls for the same destination run in order.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            DISPATCHER.submit(keyfunc(*args, **kwargs), func, *args, **kwargs)
+        return wrapped
+    return decorator
 
 def _raise_ex(ex):
     raise ex
@@ -95,69 +202,203 @@ def _raise_ex(ex):
 
 def getupdates():
     global CFG, MSG_Q
+    backoff = 1
+    # updates fetched but not handled yet are fetched again after a restart,
+    # processmsg() saves the offset
+    offset = CFG['offset']
     while 1:
+        start = time.perf_counter()
         try:
-            updates = bot_api('getUpdates', offset=CFG['offset'], timeout=10)
+            updates = bot_api('getUpdates', offset=offset, timeout=CFG['polltimeout'],
+                              limit=CFG['polllimit'], allowed_updates=ALLOWED_UPDATES)
         except Exception as ex:
-            logging.exception('Get updates failed.')
+            TG_LOG.exception('Get updates failed, retry in %d seconds.', backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
             continue
+        M_POLL.observe(time.perf_counter() - start)
+        backoff = 1
+        POLL_STATS['requests'] += 1
+        # poll again at once, an empty result already waited for polltimeout
         if updates:
-            logging.debug('Messages coming.')
-            logging.debug(updates)
-            CFG['offset'] = updates[-1]["update_id"] + 1
+            TG_LOG.debug('Messages coming: %r', updates)
+            if CAPTURE is not None:
+                CAPTURE.tg(updates)
+            POLL_STATS['updates'] += len(updates)
+            offset = updates[-1]["update_id"] + 1
             for upd in updates:
                 MSG_Q.put(upd)
-        time.sleep(.2)
+        else:
+            POLL_STATS['idle'] += 1
+        logpollstats()
+
+def setoffset(offset):
+    '''Save the update id to poll from after a restart, once the ones before are handled.'''
+    CFG['offset'] = offset
+    STATE.set('offset', offset)
+
+def logpollstats():
+    now = time.monotonic()
+    last = POLL_STATS['lastlog']
+    if now - last['time'] < 3600:
+        return
+    requests = POLL_STATS['requests'] - last['requests']
+    TG_LOG.info('Polling in the last hour: %d requests, %.2f updates/request, %d idle.',
+        requests, (POLL_STATS['updates'] - last['updates']) / (requests or 1),
+        POLL_STATS['idle'] - last['idle'])
+    POLL_STATS['lastlog'] = {'time': now, 'requests': POLL_STATS['requests'],
+        'updates': POLL_STATS['updates'], 'idle': POLL_STATS['idle']}
+
+### Webhook
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    '''Receive updates POSTed by Telegram and put them on MSG_Q.'''
+
+    def setup(self):
+        if isinstance(self.request, ssl.SSLSocket):
+            # here in the request thread, so a silent client only holds up itself
+            self.request.do_handshake()
+        http.server.BaseHTTPRequestHandler.setup(self)
+
+    def do_POST(self):
+        start = time.perf_counter()
+        secret = CFG['webhook'].get('secret')
+        if secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            upd = json.loads(self.rfile.read(length).decode('utf-8'))
+            uid = upd['update_id']
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400)
+            return
+        # Telegram retries deliveries that were not acknowledged, and
+        # sends several at once, so ids can arrive out of order
+        with WEBHOOK_LOCK:
+            duplicate = uid in WEBHOOK_SEEN
+            if not duplicate:
+                WEBHOOK_SEEN[uid] = True
+        if not duplicate:
+            if CAPTURE is not None:
+                CAPTURE.tg([upd])
+            MSG_Q.put(upd)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        latency = time.perf_counter() - start
+        with WEBHOOK_LOCK:
+            WEBHOOK_STATS['updates'] += 1
+            WEBHOOK_STATS['latency_total'] += latency
+            WEBHOOK_STATS['latency_max'] = max(WEBHOOK_STATS['latency_max'], latency)
+        TG_LOG.debug('Webhook update %s ingested in %.3f ms', uid, latency * 1000)
+
+    def log_message(self, format, *args):
+        TG_LOG.debug('Webhook: ' + format, *args)
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # failed handshakes and dropped connections from the internet
+        TG_LOG.debug('Webhook connection from %s failed.', client_address[0], exc_info=True)
+
+def startwebhook():
+    '''
+    Start the webhook HTTP server and register it with Telegram.
+    Returns False if the webhook can't be set, then polling should be used.
+    '''
+    wh = CFG['webhook']
+    server = None
+    try:
+        server = WebhookServer((wh.get('listen', ''), wh['port']), WebhookHandler)
+        if wh.get('certfile'):
+            ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ctx.load_cert_chain(wh['certfile'], wh.get('keyfile'))
+            server.socket = ctx.wrap_socket(server.socket, server_side=True,
+                                            do_handshake_on_connect=False)
+        bot_api('setWebhook', url=wh['url'], secret_token=wh.get('secret', ''),
+                allowed_updates=ALLOWED_UPDATES)
+    except Exception:
+        TG_LOG.exception('Set webhook failed, fall back to polling.')
+        if server is not None:
+            server.server_close()
+        return False
+    thr = threading.Thread(target=server.serve_forever, name='Webhook')
+    thr.daemon = True
+    thr.start()
+    TG_LOG.info('Webhook listening on port %s.', wh['port'])
+    return True
 
 def checkircconn():
     global ircconn
     if not ircconn or not ircconn.sock:
         ircconn = libirc.IRCConnection()
         ircconn.connect((CFG['ircserver'], CFG['ircport']), use_ssl=CFG['ircssl'])
+        ircconn.throttle(CFG['ircrate'], CFG['ircburst'])
+        ircconn.sendqueue.onsend = M_IRC_WAIT.observe
+        if CAPTURE is not None:
+            ircconn.onrecv = CAPTURE.irc
         if CFG.get('ircpass'):
             ircconn.setpass(CFG['ircpass'])
         ircconn.setnick(CFG['ircnick'])
         ircconn.setuser(CFG['ircnick'], CFG['ircnick'])
-        ircconn.join(CFG['ircchannel'])
-        logging.info('IRC (re)connected.')
+        ircconn.join(IRC_CHANNELS)
+        IRC_LOG.info('IRC (re)connected.')
 
 def getircupd():
-    global MSG_Q
     while 1:
-        checkircconn()
-        line = ircconn.parse(block=False)
-        if line and line["cmd"] == "PRIVMSG":
-            if line["dest"] != CFG['ircnick'] and not re.match(CFG['ircignore'], line["nick"]):
-                updateid = -int(time.time())
+        try:
+            checkircconn()
+            if not ircconn.wait(IRC_WAIT_TIMEOUT):
+                continue
+            # handle every complete line received before waiting again
+            for line in ircconn.parse_many(ircconn.recvlines(block=False)):
+                # a bad line only costs itself, not the rest of the batch
+                try:
+                    ircupdate(line)
+                except Exception:
+                    IRC_LOG.exception('Handle IRC line failed: %r', line)
+        except Exception:
+            IRC_LOG.exception('Get IRC updates failed.')
+            time.sleep(1)
+
+def ircupdate(line):
+    if line["cmd"] == "PRIVMSG":
+        # private messages to us have no route
+        chats = IRC_ROUTES.get((line["dest"] or '').lower())
+        if chats and not re.match(CFG['ircignore'], line["nick"]):
+            updateid = -IRC_IDS()
+            for chatid in chats:
                 msg = {
                     'message_id': updateid,
                     'from': {'id': CFG['ircbotid'], 'first_name': CFG['ircbotname'], 'username': 'orzirc_bot'},
                     'date': int(time.time()),
-                    'chat': {'id': -CFG['groupid'], 'title': CFG['ircchannel']},
+                    'chat': {'id': chatid, 'title': line["dest"]},
                     'text': line["msg"].strip(),
                     '_ircuser': line["nick"]
                 }
-                MSG_Q.put({'update_id': updateid, 'message': msg})
-        time.sleep(.5)
+                MSG_Q.put({'update_id': updateid, 'message': msg}, block=False)
+
+def ircnick(chat_id, message_id):
+    '''Returns the IRC nick of a Telegram message relayed from IRC, or None.'''
+    ircid = MSG_STORE.tg_to_irc(chat_id, message_id)
+    if ircid is not None:
+        return MSG_STORE.get((chat_id, ircid), {}).get('_ircuser')
 
 def ircconn_say(dest, msg, sendnow=True):
-    MIN_INT = 0.2
     if not ircconn:
         return
-    curtime = time.time()
-    delta = curtime - ircconn_say.lasttime
-    if delta < MIN_INT:
-        time.sleep(MIN_INT - delta)
+    # paced by the send queue of ircconn
     ircconn.say(dest, msg, sendnow)
-    ircconn_say.lasttime = time.time()
-ircconn_say.lasttime = 0
 
-def irc_send(text='', reply_to_message_id=None):
+def irc_send(text, chat_id, reply_to_message_id=None):
     if ircconn:
         checkircconn()
         if reply_to_message_id:
-            m = MSG_CACHE.get(reply_to_message_id, {})
-            logging.debug('Got reply message: ' + str(m))
+            m = MSG_STORE.get((chat_id, reply_to_message_id), {})
+            IRC_LOG.debug('Got reply message: %s', m)
             if '_ircuser' in m:
                 text = "%s: %s" % (m['_ircuser'], text)
             elif 'from' in m:
@@ -166,57 +407,76 @@ def irc_send(text='', reply_to_message_id=None):
                     rnmatch = re_ircforward.match(m.get('text', ''))
                     if rnmatch:
                         src = rnmatch.group(1) or src
+                    src = ircnick(chat_id, reply_to_message_id) or src
                 text = "%s: %s" % (src, text)
         lines = text.splitlines()
         if len(lines) < 3:
             text = ' '.join(lines)
         else:
             text = lines[0] + ' [...] ' + lines[-1]
-        ircconn_say(CFG['ircchannel'], text)
+        for channel in TG_ROUTES.get(chat_id, ()):
+            ircconn_say(channel, text)
 
-@async_func
+@async_func(lambda msg: ('irc',) + tuple(TG_ROUTES.get(msg['chat']['id'], ())))
 def irc_forward(msg):
     if not ircconn:
         return
+    start = time.perf_counter()
     try:
         if msg['from']['id'] == CFG['ircbotid']:
             return
+        channels = TG_ROUTES.get(msg['chat']['id'])
+        if not channels:
+            return
         checkircconn()
         text = msg.get('text', '')
         mkeys = tuple(msg.keys() & MEDIA_TYPES)
         if mkeys:
-            if text:
-                text += ' ' + servemedia(msg)
-            else:
-                text = servemedia(msg)
-        if text and not text.startswith('@@@'):
-            if 'forward_from' in msg:
-                fwdname = ''
-                if msg['forward_from']['id'] in (CFG['botid'], CFG['ircbotid']):
-                    rnmatch = re_ircforward.match(msg.get('text', ''))
-                    if rnmatch:
-                        fwdname = rnmatch.group(1) or rnmatch.group(3)
-                        text = rnmatch.group(2) or rnmatch.group(4)
-                fwdname = fwdname or smartname(msg['forward_from'])
-                text = "Fwd %s: %s" % (fwdname, text)
-            elif 'reply_to_message' in msg:
-                replname = ''
-                replyu = msg['reply_to_message']['from']
-                if replyu['id'] in (CFG['botid'], CFG['ircbotid']):
-                    rnmatch = re_ircforward.match(msg['reply_to_message'].get('text', ''))
-                    if rnmatch:
-                        replname = rnmatch.group(1) or rnmatch.group(3)
-                replname = replname or smartname(replyu)
-                text = "%s: %s" % (replname, text)
-            # ignore blank lines
-            text = list(filter(lambda s: s.strip(), text.splitlines()))
-            if len(text) > 3:
-                text = text[:3]
-                text[-1] += ' [...]'
-            for ln in text[:3]:
-                ircconn_say(CFG['ircchannel'], '[%s] %s' % (smartname(msg['from']), ln))
+            media = servemedia(msg)
+            if isinstance(media, concurrent.futures.Future):
+                # wait here, so later messages to the channels stay behind it
+                try:
+                    media = media.result()
+                except Exception:
+                    MEDIA_LOG.exception('Serve media failed.')
+                    media = '<%s>' % mkeys[0]
+            text = text + ' ' + media if text else media
+        irc_forward_text(msg, text, channels)
     except Exception:
-        logging.exception('Forward a message to IRC failed.')
+        IRC_LOG.exception('Forward a message to IRC failed.')
+    finally:
+        M_IRC_FORWARD.observe(time.perf_counter() - start)
+
+def irc_forward_text(msg, text, channels):
+    if text and not text.startswith('@@@'):
+        if 'forward_from' in msg:
+            fwdname = ''
+            if msg['forward_from']['id'] in (CFG['botid'], CFG['ircbotid']):
+                rnmatch = re_ircforward.match(msg.get('text', ''))
+                if rnmatch:
+                    fwdname = rnmatch.group(1) or rnmatch.group(3)
+                    text = rnmatch.group(2) or rnmatch.group(4)
+            fwdname = fwdname or smartname(msg['forward_from'])
+            text = "Fwd %s: %s" % (fwdname, text)
+        elif 'reply_to_message' in msg:
+            replname = ''
+            replyu = msg['reply_to_message']['from']
+            if replyu['id'] in (CFG['botid'], CFG['ircbotid']):
+                replname = ircnick(msg['chat']['id'], msg['reply_to_message']['message_id'])
+                rnmatch = re_ircforward.match(msg['reply_to_message'].get('text', ''))
+                if rnmatch and not replname:
+                    replname = rnmatch.group(1) or rnmatch.group(3)
+            replname = replname or smartname(replyu)
+            text = "%s: %s" % (replname, text)
+        # ignore blank lines
+        text = list(filter(lambda s: s.strip(), text.splitlines()))
+        if len(text) > 3:
+            text = text[:3]
+            text[-1] += ' [...]'
+        for ln in text[:3]:
+            ln = '[%s] %s' % (smartname(msg['from']), ln)
+            for channel in channels:
+                ircconn_say(channel, ln)
 
 
 ### API Related
@@ -224,27 +484,58 @@ def irc_forward(msg):
 class BotAPIFailed(Exception):
     pass
 
-def change_session():
-    global HSession
-    HSession.close()
-    HSession = requests.Session()
-    HSession.headers["User-Agent"] = USERAGENT
-    logging.warning('Session changed.')
+def tg_ratelimit(chat_id):
+    '''Wait for the per-chat limit of groups, then for the global limit.'''
+    waited = 0
+    if chat_id < 0:
+        with TG_BUCKETS_LOCK:
+            bucket = TG_BUCKETS.get(chat_id)
+            if bucket is None:
+                bucket = TG_BUCKETS[chat_id] = ratelimit.TokenBucket(
+                    CFG['tgchatrate'] / 60, CFG['tgchatburst'])
+        waited += bucket.wait()
+    waited += TG_BUCKET.wait()
+    if waited:
+        with STATS_LOCK:
+            TG_LIMIT_STATS['delayed'] += 1
+            TG_LIMIT_STATS['waited'] += waited
 
 def bot_api(method, **params):
-    for att in range(3):
+    timeout = 45
+    if method == 'getUpdates':
+        # don't give up before the server side long polling timeout
+        timeout += params.get('timeout', 0)
+    chat_id = params.get('chat_id')
+    att = 0
+    while 1:
+        if chat_id is not None:
+            tg_ratelimit(chat_id)
+        start = time.perf_counter()
         try:
-            req = HSession.get(URL + method, params=params, timeout=45)
-            retjson = req.content
-            ret = json.loads(retjson.decode('utf-8'))
+            req = HSession.get(URL + method, params=params, timeout=timeout)
+            ret = json.loads(req.content.decode('utf-8'))
+        except Exception:
+            M_BOT_API_ERRORS.labels(method).inc()
+            att += 1
+            if att >= 3:
+                raise
+            # the session reconnects by itself, just back off
+            delay = random.uniform(0.5, 1.5) * 2 ** att
+            API_LOG.warning('Bot API %s failed, retry in %.1fs.', method, delay)
+            time.sleep(delay)
+            continue
+        M_BOT_API.labels(method).observe(time.perf_counter() - start)
+        retry_after = ret.get('parameters', {}).get('retry_after')
+        if ret['ok'] or not retry_after:
             break
-        except Exception as ex:
-            if att < 1:
-                time.sleep((att+1) * 2)
-                change_session()
-            else:
-                raise ex
+        # flood control, the request will succeed after exactly this long
+        API_LOG.warning('Bot API %s throttled for %ss.', method, retry_after)
+        with STATS_LOCK:
+            TG_LIMIT_STATS['throttled'] += 1
+            TG_LIMIT_STATS['waited'] += retry_after
+        time.sleep(retry_after)
     if not ret['ok']:
+        M_BOT_API_ERRORS.labels(method).inc()
         raise BotAPIFailed(repr(ret))
     return ret['result']
 
@@ -252,48 +543,117 @@ def bot_api_noerr(method, **params):
     try:
         bot_api(method, **params)
     except Exception:
-        logging.exception('Async bot API failed.')
+        API_LOG.exception('Async bot API failed.')
 
-def sync_sendmsg(text, chat_id, reply_to_message_id=None):
+def sync_sendmsg(text, chat_id, reply_to_message_id=None, ircid=None, maxlen=2000):
+    '''
+    ircid is the id of the IRC line relayed, or a list of them if
+    several lines are relayed as one message.
+    '''
     text = text.strip()
     if not text:
-        logging.warning('Empty message ignored: %s, %s' % (chat_id, reply_to_message_id))
+        API_LOG.warning('Empty message ignored: %s, %s', chat_id, reply_to_message_id)
         return
-    logging.info('sendMessage(%s): %s' % (len(text), text[:20]))
-    if len(text) > 2000:
-        text = text[:1999] + '…'
+    API_LOG.info('sendMessage(%s): %.20s', len(text), text)
+    if len(text) > maxlen:
+        text = text[:maxlen-1] + '…'
     reply_id = reply_to_message_id
     if reply_to_message_id and reply_to_message_id < 0:
-        reply_id = None
+        # an IRC line, reply to where it was relayed if we know
+        reply_id = MSG_STORE.irc_to_tg(chat_id, reply_to_message_id)
     m = bot_api('sendMessage', chat_id=chat_id, text=text, reply_to_message_id=reply_id)
-    if chat_id == -CFG['groupid']:
-        MSG_CACHE[m['message_id']] = m
+    if chat_id in TG_ROUTES:
+        MSG_STORE[(chat_id, m['message_id'])] = m
+        if isinstance(ircid, list):
+            for i in ircid:
+                MSG_STORE.link(chat_id, m['message_id'], i)
+        elif ircid is not None:
+            MSG_STORE.link(chat_id, m['message_id'], ircid)
         # IRC messages
         if reply_to_message_id is not None:
-            irc_send(text, reply_to_message_id)
+            irc_send(text, chat_id, reply_to_message_id)
     return m
 
-sendmsg = async_func(sync_sendmsg)
+sendmsg = async_func(lambda text, chat_id, *args, **kwargs: ('tg', chat_id))(sync_sendmsg)
+
+def sendlines(chat_id, lines):
+    '''Send a batch of (text, ircid) from COALESCER as one message.'''
+    DISPATCHER.submit(('tg', chat_id), sync_sendmsg, '\n'.join(l[0] for l in lines),
+        chat_id, ircid=[l[1] for l in lines], maxlen=TG_MSG_LIMIT)
 
-@async_func
+def sendline(text, chat_id, ircid):
+    '''Send an IRC line to Telegram, coalesced with the following ones if enabled.'''
+    if COALESCER is None:
+        sendmsg(text, chat_id, ircid=ircid)
+        return
+    text = text.strip()
+    if len(text) > 2000:
+        text = text[:1999] + '…'
+    COALESCER.add(chat_id, (text, ircid), len(text) + 1)
+
+@async_func(lambda chat_id: ('tg', chat_id))
 def typing(chat_id):
-    logging.info('sendChatAction: %r' % chat_id)
+    API_LOG.info('sendChatAction: %r', chat_id)
     bot_api('sendChatAction', chat_id=chat_id, action='typing')
 
 def getfile(file_id):
-    logging.info('getFile: %r' % file_id)
+    API_LOG.info('getFile: %r', file_id)
     return bot_api('getFile', file_id=file_id)
 
+def mediasession(poolsize):
+    '''A keep-alive session for media transfers, one connection per media worker.'''
+    session = requests.Session()
+    session.headers["User-Agent"] = USERAGENT
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=poolsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def mediastats():
+    '''Returns MEDIA_STATS with throughput in MB/s and connections opened.'''
+    with STATS_LOCK:
+        ret = dict(MEDIA_STATS)
+    for kind in ('download', 'upload'):
+        t = ret[kind + '_time']
+        ret[kind + '_mbps'] = ret[kind + '_bytes'] / t / 1e6 if t else 0.
+    connections = 0
+    for adapter in set(MSession.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+    ret['connections'] = connections
+    return ret
+
 def retrieve(url, filename, raisestatus=True):
-    # NOTE the stream=True parameter
-    r = requests.get(url, stream=True)
-    if raisestatus:
-        r.raise_for_status()
-    with open(filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk: # filter out keep-alive new chunks
-                f.write(chunk)
-        f.flush()
+    '''Download to filename + '.part', then rename it to filename.'''
+    start = time.perf_counter()
+    tmpname = filename + mediacache.PARTIAL_SUFFIX
+    size = 0
+    try:
+        # NOTE the stream=True parameter
+        with MSession.get(url, stream=True, timeout=60) as r:
+            if raisestatus:
+                r.raise_for_status()
+            with open(tmpname, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=MEDIA_CHUNK):
+                    f.write(chunk)
+                    size += len(chunk)
+        os.replace(tmpname, filename)
+    except BaseException:
+        try:
+            os.unlink(tmpname)
+        except FileNotFoundError:
+            pass
+        raise
+    elapsed = time.perf_counter() - start
+    M_MEDIA_DOWNLOAD.observe(elapsed)
+    with STATS_LOCK:
+        MEDIA_STATS['downloads'] += 1
+        MEDIA_STATS['download_bytes'] += size
+        MEDIA_STATS['download_time'] += elapsed
+    MEDIA_LOG.debug('Downloaded %s: %d bytes in %.3fs.', os.path.basename(filename), size, elapsed)
     return r.status_code
 
 def classify(msg):
@@ -332,7 +692,7 @@ def classify(msg):
         # Group chat
         if 'new_chat_participant' in msg:
             return 3
-        if chat['id'] == -CFG['groupid']:
+        if chat['id'] in TG_ROUTES:
             if msg['from']['id'] == CFG['botid']:
                 return 10
             else:
@@ -350,9 +710,9 @@ def command(text, chatid, replyid, msg):
         if t[0][0] in "/'":
             cmd = t[0][1:].lower().replace('@' + CFG['botname'].lower(), '')
             if cmd in COMMANDS:
-                if chatid > 0 or chatid == -CFG['groupid']:
+                if chatid > 0 or chatid in TG_ROUTES:
                     expr = ' '.join(t[1:]).strip()
-                    logging.info('Command: /%s %s' % (cmd, expr[:20]))
+                    TG_LOG.info('Command: /%s %.20s', cmd, expr)
                     COMMANDS[cmd](expr, chatid, replyid, msg)
                 else:
                     sendmsg('The commmand is not available in this group.', chatid, replyid)
@@ -363,49 +723,71 @@ def command(text, chatid, replyid, msg):
             #COMMANDS['m'](' '.join(t), chatid, replyid, msg)
         elif chatid > 0:
             t = ' '.join(t).strip()
-            logging.info('Reply: ' + t[:20])
+            TG_LOG.info('Reply: %.20s', t)
             COMMANDS['reply'](t, chatid, replyid, msg)
     except Exception:
-        logging.exception('Excute command failed.')
+        TG_LOG.exception('Excute command failed.')
 
 def processmsg():
     d = MSG_Q.get()
-    logging.debug('Msg arrived: %r' % d)
-    uid = d['update_id']
+    M_QUEUE_WAIT.observe(time.monotonic() - d['_qtime'])
+    TG_LOG.debug('Msg arrived: %r', d)
+    try:
+        handleupdate(d)
+    finally:
+        # IRC lines have negative ids, webhook updates can come out of order
+        if d['update_id'] >= CFG['offset']:
+            setoffset(d['update_id'] + 1)
+
+def handleupdate(d):
     if 'message' in d:
         msg = d['message']
         if 'text' in msg:
             msg['text'] = msg['text'].replace('\xa0', ' ')
         elif 'caption' in msg:
             msg['text'] = msg['caption'].replace('\xa0', ' ')
-        MSG_CACHE[msg['message_id']] = msg
+        if msg['chat']['id'] in TG_ROUTES:
+            # replies are only looked up in the bridged groups
+            MSG_STORE[(msg['chat']['id'], msg['message_id'])] = msg
+        start = time.perf_counter()
         cls = classify(msg)
-        logging.debug('Classified as: %s', cls)
-        if msg['chat']['id'] == -CFG['groupid'] and CFG.get('t2i'):
+        M_CLASSIFY.observe(time.perf_counter() - start)
+        TG_LOG.debug('Classified as: %s', cls)
+        if TOGGLES['t2i'].get(msg['chat']['id']):
             irc_forward(msg)
         if cls == 0:
-            rid = msg['message_id']
-            if CFG.get('i2t') and '_ircuser' in msg:
-                if CFG.get('shownick'):
-                    rid = sync_sendmsg('[%s] %s' % (msg['_ircuser'], msg['text']), msg['chat']['id'])['message_id']
-                else:
-                    rid = sync_sendmsg('%s' % msg['text'], msg['chat']['id'])['message_id']
-            command(msg['text'], msg['chat']['id'], rid, msg)
+            if '_ircuser' in msg and TOGGLES['i2t'].get(msg['chat']['id']):
+                if COALESCER is not None:
+                    COALESCER.flush(msg['chat']['id'])
+                # after the lines flushed above, and without waiting
+                # for rate limits here
+                DISPATCHER.submit(('tg', msg['chat']['id']), irc_command, msg)
+            else:
+                command(msg['text'], msg['chat']['id'], msg['message_id'], msg)
         elif cls == 2:
-            if CFG.get('i2t'):
+            if TOGGLES['i2t'].get(msg['chat']['id']):
                 act = re_ircaction.match(msg['text'])
                 if act:
-                    sendmsg('** %s %s **' % (msg['_ircuser'], act.group(1)), msg['chat']['id'])
+                    sendline('** %s %s **' % (msg['_ircuser'], act.group(1)), msg['chat']['id'], msg['message_id'])
                 elif CFG.get('shownick'):
-                    sendmsg('[%s] %s' % (msg['_ircuser'], msg['text']), msg['chat']['id'])
+                    sendline('[%s] %s' % (msg['_ircuser'], msg['text']), msg['chat']['id'], msg['message_id'])
                 else:
-                    sendmsg('%s' % msg['text'], msg['chat']['id'])
+                    sendline('%s' % msg['text'], msg['chat']['id'], msg['message_id'])
         elif cls == -1:
             sendmsg('Wrong usage', msg['chat']['id'], msg['message_id'])
 
-def cachemedia(msg):
+def irc_command(msg):
+    '''Relay a command said on IRC to Telegram, then run it as a reply to that.'''
+    if CFG.get('shownick'):
+        m = sync_sendmsg('[%s] %s' % (msg['_ircuser'], msg['text']), msg['chat']['id'], ircid=msg['message_id'])
+    else:
+        m = sync_sendmsg('%s' % msg['text'], msg['chat']['id'], ircid=msg['message_id'])
+    command(msg['text'], msg['chat']['id'], m['message_id'] if m else msg['message_id'], msg)
+
+def mediafile(msg):
     '''
-    Download specified media if not exist.
+    Returns (file_id, file_size, file_ext) of the media in msg.
+    file_ext is '' if it can only be known from getFile.
     '''
     mt = msg.keys() & frozenset(('audio', 'document', 'sticker', 'video', 'voice'))
     file_ext = ''
@@ -420,29 +802,130 @@ def cachemedia(msg):
         file_id = photo['file_id']
         file_size = photo.get('file_size')
         file_ext = '.jpg'
+    return file_id, file_size, file_ext
+
+def cachemedia_shared(msg):
+    '''
+    cachemedia(), but concurrent calls for the same file wait for one
+    download instead of starting their own.
+    '''
+    file_id = mediafile(msg)[0]
+    with MEDIA_LOCK:
+        future = MEDIA_INFLIGHT.get(file_id)
+        owner = future is None
+        if owner:
+            future = MEDIA_INFLIGHT[file_id] = concurrent.futures.Future()
+    if not owner:
+        return future.result()
+    try:
+        result = cachemedia(msg)
+        future.set_result(result)
+        return result
+    except Exception as ex:
+        future.set_exception(ex)
+        raise
+    finally:
+        with MEDIA_LOCK:
+            del MEDIA_INFLIGHT[file_id]
+
+def cachemedia_noerr(msg, cachename=None):
+    '''cachemedia_shared() in the background. cachename is marked pending by the caller.'''
+    try:
+        cachemedia_shared(msg)
+    except Exception:
+        MEDIA_LOG.exception('Download media failed.')
+    finally:
+        if cachename:
+            MEDIA_CACHE.end(cachename)
+
+def cachemedia(msg):
+    '''
+    Download specified media if not exist.
+    '''
+    file_id, file_size, file_ext = mediafile(msg)
+    if file_ext:
+        # the name is known, skip getFile on a hit
+        cachename = file_id + file_ext
+        if MEDIA_CACHE.lookup(cachename, file_size):
+            return (cachename, 304)
     fp = getfile(file_id)
     file_size = fp.get('file_size') or file_size
     file_path = fp.get('file_path')
     if not file_path:
         raise BotAPIFailed("can't get file_path for " + file_id)
-    file_ext = os.path.splitext(file_path)[1] or file_ext
-    cachename = file_id + file_ext
+    if not file_ext:
+        file_ext = os.path.splitext(file_path)[1]
+        cachename = file_id + file_ext
+        if MEDIA_CACHE.lookup(cachename, file_size):
+            return (cachename, 304)
     fpath = os.path.join(CFG['cachepath'], cachename)
+    MEDIA_CACHE.begin(cachename, file_size)
     try:
-        if os.path.isfile(fpath) and os.path.getsize(fpath) == file_size:
-            return (cachename, 304)
-    except Exception:
-        pass
-    return (cachename, retrieve(URL_FILE + file_path, fpath))
+        code = retrieve(URL_FILE + file_path, fpath)
+        MEDIA_CACHE.add(cachename, os.path.getsize(fpath))
+    finally:
+        MEDIA_CACHE.end(cachename)
+    return (cachename, code)
 
 def timestring_a(seconds):
     m, s = divmod(seconds, 60)
     h, m = divmod(m, 60)
     return '%d:%02d:%02d' % (h, m, s)
 
+class MultipartFile:
+    '''
+    A multipart/form-data body with a single file field. requests reads
+    it in chunks, so the file is streamed instead of loaded into memory.
+    '''
+
+    def __init__(self, field, filename, fileobj, size):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        head = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n' % (boundary, field, filename)).encode('utf-8')
+        tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+        self.parts = [io.BytesIO(head), fileobj, io.BytesIO(tail)]
+        self.length = len(head) + size + len(tail)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        buf = []
+        while size > 0 and self.parts:
+            data = self.parts[0].read(size)
+            if not data:
+                self.parts.pop(0)
+                continue
+            buf.append(data)
+            size -= len(data)
+        return b''.join(buf)
+
+    def __iter__(self):
+        return iter(functools.partial(self.read, MEDIA_CHUNK), b'')
+
+def uploadmedia(msg, ret):
+    fname, code = cachemedia_shared(msg)
+    fpath = os.path.join(CFG['cachepath'], fname)
+    start = time.perf_counter()
+    with open(fpath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        body = MultipartFile('name', fname, f, size)
+        r = MSession.post('http://img.vim-cn.com/', data=body,
+                          headers={'Content-Type': body.content_type}, timeout=60)
+    with STATS_LOCK:
+        MEDIA_STATS['uploads'] += 1
+        MEDIA_STATS['upload_bytes'] += size
+        MEDIA_STATS['upload_time'] += time.perf_counter() - start
+    return ret + ' ' + r.text
+
 def servemedia(msg):
     '''
     Reply type and link of media. This only generates links for photos.
+    Returns a Future in the media pool if the link is only known after
+    downloading and uploading the photo.
     '''
     keys = tuple(msg.keys() & MEDIA_TYPES)
     if not keys:
@@ -450,13 +933,17 @@ def servemedia(msg):
     ret = '<%s>' % keys[0]
     if 'photo' in msg:
         servemode = CFG.get('servemedia')
-        if servemode:
-            fname, code = cachemedia(msg)
-            if servemode == 'self':
-                ret += ' %s%s' % (CFG['serveurl'], fname)
-            elif servemode == 'vim-cn':
-                r = requests.post('http://img.vim-cn.com/', files={'name': open(os.path.join(CFG['cachepath'], fname), 'rb')})
-                ret += ' ' + r.text
+        if servemode == 'self':
+            # the name is known in advance, download in the background
+            file_id, file_size, file_ext = mediafile(msg)
+            cachename = file_id + file_ext
+            ret += ' %s%s' % (CFG['serveurl'], cachename)
+            # the media server waits for pending files, until getFile
+            # returns and the download starts too
+            MEDIA_CACHE.begin(cachename, file_size)
+            media_executor.submit(cachemedia_noerr, msg, cachename)
+        elif servemode == 'vim-cn':
+            return media_executor.submit(uploadmedia, msg, ret)
     elif 'sticker' in msg:
         if msg['sticker'].get('emoji'):
             ret = msg['sticker']['emoji'] + ' ' + ret
@@ -486,35 +973,82 @@ def smartname(user, limit=20):
     else:
         return pn
 
+def build_routes(cfg):
+    '''
+    Build the routing tables from the "bridges" list in config, or from
+    groupid/groupname/ircchannel if there is no such list.
+
+    Returns (tg_routes, irc_routes, group_names):
+    Telegram chat id -> IRC channels, lowercased IRC channel -> Telegram
+    chat ids, and Telegram chat id -> group name.
+    '''
+    bridges = cfg.get('bridges') or [{
+        'groupid': cfg['groupid'],
+        'groupname': cfg.get('groupname', ''),
+        'ircchannel': cfg['ircchannel']
+    }]
+    tg_routes = collections.OrderedDict()
+    irc_routes = {}
+    group_names = collections.OrderedDict()
+    for bridge in bridges:
+        chatid = -bridge['groupid']
+        channel = bridge['ircchannel']
+        tg_routes.setdefault(chatid, []).append(channel)
+        irc_routes.setdefault(channel.lower(), []).append(chatid)
+        group_names[chatid] = bridge.get('groupname', '')
+    return tg_routes, irc_routes, group_names
+
+def bridges_desc():
+    return '; '.join('%s (Telegram group) and %s (IRC channel)' % (
+        GROUP_NAMES[chatid], ', '.join(channels))
+        for chatid, channels in TG_ROUTES.items())
+
+def load_toggles():
+    '''
+    Returns {"t2i": {chat id: on}, "i2t": {chat id: on}} of the bridged
+    groups, from the state or else from the config.
+    '''
+    toggles = {}
+    for key in ('t2i', 'i2t'):
+        # saved before the toggles were kept per group
+        default = STATE.get(key, CFG.get(key))
+        toggles[key] = {chatid: STATE.get('%s/%d' % (key, chatid), default)
+                        for chatid in TG_ROUTES}
+    return toggles
+
+def settoggle(key, chatid, expr):
+    '''Turn forwarding `key` of a group on or off as in expr, or flip it. Returns the new value.'''
+    if expr in ('on', 'off'):
+        value = expr == 'on'
+    else:
+        value = not TOGGLES[key][chatid]
+    TOGGLES[key][chatid] = value
+    STATE.set('%s/%d' % (key, chatid), value)
+    return value
+
 def cmd_t2i(expr, chatid, replyid, msg):
-    '''/t2i [on|off] Toggle Telegram to IRC forwarding.'''
-    global CFG
-    if msg['chat']['id'] == -CFG['groupid']:
-        if expr == 'off' or CFG.get('t2i'):
-            CFG['t2i'] = False
-            sendmsg('Telegram to IRC forwarding disabled.', chatid, replyid)
-        elif expr == 'on' or not CFG.get('t2i'):
-            CFG['t2i'] = True
+    '''/t2i [on|off] Toggle Telegram to IRC forwarding of this group.'''
+    if chatid in TG_ROUTES:
+        if settoggle('t2i', chatid, expr):
             sendmsg('Telegram to IRC forwarding enabled.', chatid, replyid)
+        else:
+            sendmsg('Telegram to IRC forwarding disabled.', chatid, replyid)
     else:
-        sendmsg('Only available in the group ' + CFG['groupname'], chatid, replyid)
+        sendmsg('Only available in the groups: ' + ', '.join(GROUP_NAMES.values()), chatid, replyid)
 
 def cmd_i2t(expr, chatid, replyid, msg):
-    '''/i2t [on|off] Toggle IRC to Telegram forwarding.'''
-    global CFG
-    if msg['chat']['id'] == -CFG['groupid']:
-        if expr == 'off' or CFG.get('i2t'):
-            CFG['i2t'] = False
-            sendmsg('IRC to Telegram forwarding disabled.', chatid, replyid)
-        elif expr == 'on' or not CFG.get('i2t'):
-            CFG['i2t'] = True
+    '''/i2t [on|off] Toggle IRC to Telegram forwarding of this group.'''
+    if chatid in TG_ROUTES:
+        if settoggle('i2t', chatid, expr):
             sendmsg('IRC to Telegram forwarding enabled.', chatid, replyid)
+        else:
+            sendmsg('IRC to Telegram forwarding disabled.', chatid, replyid)
     else:
-        sendmsg('Only available in the group ' + CFG['groupname'], chatid, replyid)
+        sendmsg('Only available in the groups: ' + ', '.join(GROUP_NAMES.values()), chatid, replyid)
 
 def cmd_start(expr, chatid, replyid, msg):
-    if chatid != -CFG['groupid']:
-        sendmsg('This is %s. It can forward messages between %s (Telegram group) and %s (IRC channel).\nSend me /help for help.' % (CFG['botname'], CFG['groupname'], CFG['ircchannel']), chatid, replyid)
+    if chatid not in TG_ROUTES:
+        sendmsg('This is %s. It can forward messages between %s.\nSend me /help for help.' % (CFG['botname'], bridges_desc()), chatid, replyid)
 
 def cmd_help(expr, chatid, replyid, msg):
     '''/help Show usage.'''
@@ -527,55 +1061,259 @@ def cmd_help(expr, chatid, replyid, msg):
                 sendmsg('Help is not available for ' + expr, chatid, replyid)
         else:
             sendmsg('Command not found.', chatid, replyid)
-    elif chatid == -CFG['groupid']:
+    elif chatid in TG_ROUTES:
         sendmsg('Full help disabled in this group.', chatid, replyid)
     elif chatid > 0:
-        sendmsg('This is %s. It can forward messages between %s (Telegram group) and %s (IRC channel).\n' % (CFG['botname'], CFG['groupname'], CFG['ircchannel']) + '\n'.join(cmd.__doc__ for cmd in COMMANDS.values() if cmd.__doc__), chatid, replyid)
+        sendmsg('This is %s. It can forward messages between %s.\n' % (CFG['botname'], bridges_desc()) + '\n'.join(cmd.__doc__ for cmd in COMMANDS.values() if cmd.__doc__), chatid, replyid)
+
+def cmd_stats(expr, chatid, replyid, msg):
+    '''/stats Show message counts and latencies.'''
+    if chatid not in TG_ROUTES and msg['from']['id'] not in CFG.get('admins', ()):
+        sendmsg('Only available to admins and in the groups.', chatid, replyid)
+        return
+    lines = ['Up %d minutes, %d updates waiting.' % (
+        (time.monotonic() - START_TIME) / 60, MSG_Q.qsize())]
+    lines.extend(metrics.summary())
+    sendmsg('\n'.join(lines), chatid, replyid, maxlen=TG_MSG_LIMIT)
+
+def cmd_profile(expr, chatid, replyid, msg):
+    '''/profile cpu|mem start|snapshot|stop Profile the relay (admins only).'''
+    if msg['from']['id'] not in CFG.get('admins', ()):
+        sendmsg('Only available to admins.', chatid, replyid)
+        return
+    what, _, action = expr.partition(' ')
+    sendmsg(profile(what, action.strip()), chatid, replyid)
+
+def profiledir():
+    # not in cachepath, which may be served to anyone
+    path = CFG.get('profiledir') or os.path.join(
+        os.path.dirname(os.path.abspath(CFG.get('statefile', 'state.journal'))), 'profiles')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def profile(what, action):
+    '''Start or stop a profiler, or take a memory snapshot. Returns a message for humans.'''
+    with PROFILE_LOCK:
+        return _profile(what, action)
+
+def _profile(what, action):
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    if what == 'cpu':
+        if action == 'start':
+            if CPU_PROFILER.running:
+                return 'CPU profiling is already running.'
+            CPU_PROFILER.start()
+            return 'CPU profiling started.'
+        elif action == 'stop':
+            if not CPU_PROFILER.running:
+                return 'CPU profiling is not running.'
+            CPU_PROFILER.stop()
+            path = os.path.join(profiledir(), 'cpu-%s.folded' % stamp)
+            CPU_PROFILER.write(path)
+            return 'CPU profile of %d samples in %.0fs written to %s\n%s' % (
+                CPU_PROFILER.count, time.monotonic() - CPU_PROFILER.started, path,
+                '\n'.join('%.1f%% %s' % (share * 100, name) for name, share in CPU_PROFILER.top()))
+    elif what == 'mem':
+        if action == 'start':
+            if MEM_PROFILER.running:
+                return 'Memory tracing is already running.'
+            MEM_PROFILER.start()
+            return 'Memory tracing started.'
+        elif action == 'snapshot':
+            if not MEM_PROFILER.running:
+                return 'Memory tracing is not running.'
+            path = os.path.join(profiledir(), 'mem-%s.txt' % stamp)
+            size = MEM_PROFILER.snapshot(path)
+            return 'Memory snapshot of %.1f MiB traced written to %s' % (size / 1048576, path)
+        elif action == 'stop':
+            MEM_PROFILER.stop()
+            return 'Memory tracing stopped.'
+    return 'Usage: /profile cpu start|stop, /profile mem start|snapshot|stop'
+
+def profile_signal(signum, frame):
+    '''SIGUSR1 starts or stops CPU profiling, SIGUSR2 starts memory tracing or takes a snapshot.'''
+    # the interrupted main thread may hold PROFILE_LOCK
+    thr = threading.Thread(target=profile_toggle, args=(signum,), name='Profile')
+    thr.daemon = True
+    thr.start()
+
+def profile_toggle(signum):
+    with PROFILE_LOCK:
+        if signum == signal.SIGUSR1:
+            ret = _profile('cpu', 'stop' if CPU_PROFILER.running else 'start')
+        else:
+            ret = _profile('mem', 'snapshot' if MEM_PROFILER.running else 'start')
+    LOG.info(ret)
+
+def register_metrics():
+    '''Export the statistics kept by other parts as metrics.'''
+    metrics.collect('relay_poll_total', 'getUpdates requests, updates received and idle requests.',
+        lambda: {k: POLL_STATS[k] for k in ('requests', 'updates', 'idle')}, ('kind',), 'counter')
+    metrics.collect_stats('relay_webhook', 'Webhook updates and ingest latency in seconds.',
+        lambda: {k: WEBHOOK_STATS[k] for k in ('updates', 'latency_total', 'latency_max')},
+        ('updates', 'latency_total'))
+    metrics.collect_stats('relay_ingest_queue', 'Queue of incoming updates.', MSG_Q.stats,
+        ('dropped', 'collapsed', 'count', 'wait_total'))
+    metrics.collect('relay_tg_ratelimit_total', 'Bot API calls delayed by rate limits.',
+        lambda: dict(TG_LIMIT_STATS), ('stat',), 'counter')
+    metrics.collect_stats('relay_irc_sendqueue', 'Queue of lines sent to IRC.',
+        lambda: ircconn.sendqueue.stats() if ircconn and ircconn.sendqueue else {},
+        ('sent', 'dropped', 'wait_total'))
+    metrics.collect('relay_dispatch_depth', 'Sends waiting by destination.',
+        lambda: {' '.join(map(str, k)): v[0] for k, v in DISPATCHER.stats().items()}, ('dest',))
+    metrics.collect('relay_dispatch_age_seconds', 'Age of the oldest waiting send by destination.',
+        lambda: {' '.join(map(str, k)): v[1] for k, v in DISPATCHER.stats().items()}, ('dest',))
+    metrics.collect_stats('relay_media', 'Media transfers.', mediastats,
+        ('downloads', 'download_bytes', 'download_time', 'uploads', 'upload_bytes', 'upload_time'))
+    metrics.collect_stats('relay_media_cache', 'Media cache.',
+        lambda: MEDIA_CACHE.stats() if MEDIA_CACHE else {}, ('hits', 'misses', 'evictions'))
+    metrics.collect_stats('relay_cache', 'In-memory caches.',
+        lambda: {(name, k): v for name, cache in (('user', USER_CACHE), ('msg', MSG_STORE.hot))
+                 for k, v in cache.stats().items()},
+        ('hits', 'misses', 'evictions', 'expirations'), ('cache', 'stat'))
 
 # should document usage in docstrings
 COMMANDS = collections.OrderedDict((
 ('start', cmd_start),
 ('t2i', cmd_t2i),
 ('i2t', cmd_i2t),
+('stats', cmd_stats),
+('profile', cmd_profile),
 ('help', cmd_help)
 ))
 
-USER_CACHE = LRUCache(20)
-MSG_CACHE = LRUCache(10)
-CFG = json.load(open('config.json', 'r', encoding='utf-8'))
-CFG['offset'] = CFG.get('offset', 0)
-URL = 'https://api.telegram.org/bot%s/' % CFG['token']
-URL_FILE = 'https://api.telegram.org/file/bot%s/' % CFG['token']
+# levels can be set per subsystem, see "loglevels" in README.md
+LOG = logging.getLogger('relay')
+TG_LOG = logging.getLogger('relay.tg')
+API_LOG = logging.getLogger('relay.api')
+IRC_LOG = logging.getLogger('relay.irc')
+MEDIA_LOG = logging.getLogger('relay.media')
+USER_CACHE = lrucache.LRUCache(20)
+START_TIME = time.monotonic()
+M_POLL = metrics.histogram('relay_poll_seconds', 'getUpdates round trip.')
+M_QUEUE_WAIT = metrics.histogram('relay_queue_wait_seconds', 'Time updates wait in the ingest queue.')
+M_CLASSIFY = metrics.histogram('relay_classify_seconds', 'Time to classify a message.')
+M_IRC_FORWARD = metrics.histogram('relay_irc_forward_seconds', 'Time to forward a message to IRC.')
+M_IRC_WAIT = metrics.histogram('relay_irc_send_wait_seconds', 'Time lines wait in the IRC send queue.')
+M_BOT_API = metrics.histogram('relay_bot_api_seconds', 'Bot API request round trip.', ('method',))
+M_BOT_API_ERRORS = metrics.counter('relay_bot_api_errors_total', 'Failed Bot API requests.', ('method',))
+M_MEDIA_DOWNLOAD = metrics.histogram('relay_media_download_seconds', 'Media download time.')
+TG_BUCKETS = {}
+TG_BUCKETS_LOCK = threading.Lock()
+# updated by several threads, under STATS_LOCK
+TG_LIMIT_STATS = {'delayed': 0, 'throttled': 0, 'waited': 0.}
+MEDIA_STATS = {'downloads': 0, 'download_bytes': 0, 'download_time': 0.,
+    'uploads': 0, 'upload_bytes': 0, 'upload_time': 0.}
+STATS_LOCK = threading.Lock()
+# file_id -> Future of downloads in progress
+MEDIA_INFLIGHT = {}
+MEDIA_LOCK = threading.Lock()
+MEDIA_CACHE = None
+CAPTURE = None
+CPU_PROFILER = profiler.SamplingProfiler()
+MEM_PROFILER = profiler.MemoryProfiler()
+PROFILE_LOCK = threading.Lock()
+WEBHOOK_STATS = {'updates': 0, 'latency_total': 0., 'latency_max': 0.}
+# update ids received lately, to drop deliveries retried by Telegram
+WEBHOOK_SEEN = lrucache.LRUCache(1000)
+WEBHOOK_LOCK = threading.Lock()
+POLL_STATS = {'requests': 0, 'updates': 0, 'idle': 0,
+    'lastlog': {'time': time.monotonic(), 'requests': 0, 'updates': 0, 'idle': 0}}
+ircconn = None
 
-CFG.setdefault('shownick', True)
+def init(cfg):
+    '''Set up the state shared by the threads from the config. This doesn't touch the network.'''
+    global CFG, MSG_STORE, STATE, IRC_IDS, URL, URL_FILE
+    global TG_ROUTES, IRC_ROUTES, GROUP_NAMES, IRC_CHANNELS, TOGGLES, TG_BUCKET
+    global MSG_Q, DISPATCHER, COALESCER, media_executor, MSession, MEDIA_CACHE, CAPTURE
+    CFG = cfg
+    MSG_STORE = msgstore.MessageStore(CFG.get('msgstore', 'messages.db'),
+        lrucache.LRUCache, CFG.get('msgstoresize', 500000))
+    # offset and toggles in config.json are only initial values
+    STATE = journal.StateJournal(CFG.get('statefile', 'state.journal'))
+    CFG['offset'] = STATE.get('offset', CFG.get('offset', 0))
+    # ids of IRC lines, negated to be message_id; older ones were -time()
+    IRC_IDS = journal.IdAllocator(STATE, 'ircid', int(time.time()))
+    URL = '%sbot%s/' % (CFG.get('apiurl', API_URL), CFG['token'])
+    URL_FILE = '%sfile/bot%s/' % (CFG.get('apiurl', API_URL), CFG['token'])
 
-MSG_Q = queue.Queue()
-executor = concurrent.futures.ThreadPoolExecutor(3)
+    CFG.setdefault('shownick', True)
+    CFG.setdefault('ircrate', 2)
+    CFG.setdefault('ircburst', 5)
+    CFG.setdefault('polltimeout', 50)
+    CFG.setdefault('polllimit', 100)
+    CFG.setdefault('tgrate', 30)
+    CFG.setdefault('tgchatrate', 20)
+    CFG.setdefault('tgchatburst', 5)
 
-getme = bot_api('getMe')
-CFG['botid'] = getme['id']
-CFG['botname'] = getme.get('username', '')
+    TG_ROUTES, IRC_ROUTES, GROUP_NAMES = build_routes(CFG)
+    IRC_CHANNELS = list(collections.OrderedDict.fromkeys(
+        channel for channels in TG_ROUTES.values() for channel in channels))
+    TOGGLES = load_toggles()
 
-pollthr = threading.Thread(target=getupdates)
-pollthr.daemon = True
-pollthr.start()
+    TG_BUCKET = ratelimit.TokenBucket(CFG['tgrate'], CFG['tgrate'])
+    MSG_Q = IngestQueue(CFG.get('queuesize', 1000), CFG.get('queuepolicy', 'block'))
+    DISPATCHER = dispatcher.Dispatcher(CFG.get('workers', 3))
+    if CFG.get('coalesce', 1):
+        COALESCER = coalescer.Coalescer(sendlines, CFG.get('coalesce', 1), TG_MSG_LIMIT)
+    else:
+        COALESCER = None
+    media_executor = concurrent.futures.ThreadPoolExecutor(CFG.get('mediaworkers', 4))
+    MSession = mediasession(CFG.get('mediaworkers', 4))
+    if CFG.get('servemedia'):
+        MEDIA_CACHE = mediacache.MediaCache(CFG['cachepath'],
+            CFG.get('cachesize', 1024) * 1024 * 1024, CFG.get('cachettl', 86400))
+    if CFG.get('capture'):
+        CAPTURE = capture.CaptureWriter(CFG['capture'])
 
-ircconn = None
-if 'ircserver' in CFG:
-    checkircconn()
-    ircthr = threading.Thread(target=getircupd)
-    ircthr.daemon = True
-    ircthr.start()
+def start():
+    '''Log in and start the threads receiving from Telegram and IRC.'''
+    getme = bot_api('getMe')
+    CFG['botid'] = getme['id']
+    CFG['botname'] = getme.get('username', '')
 
-logging.info('Satellite launched.')
+    if MEDIA_CACHE and CFG['servemedia'] == 'self' and CFG.get('serveport'):
+        mediaserver.serve((CFG.get('servelisten', ''), CFG['serveport']), MEDIA_CACHE)
+    register_metrics()
+    if CFG.get('metricsport'):
+        metrics.serve((CFG.get('metricslisten', ''), CFG['metricsport']))
+    if not (CFG.get('webhook') and startwebhook()):
+        # getUpdates doesn't work while a webhook is set
+        bot_api('deleteWebhook')
+        pollthr = threading.Thread(target=getupdates)
+        pollthr.daemon = True
+        pollthr.start()
 
-try:
-    while 1:
-        try:
-            processmsg()
-        except Exception as ex:
-            logging.exception('Failed to process a message.')
-            continue
-finally:
-    json.dump(CFG, open('config.json', 'w'), sort_keys=True, indent=4)
-    logging.info('Shut down cleanly.')
+    if 'ircserver' in CFG:
+        checkircconn()
+        ircthr = threading.Thread(target=getircupd)
+        ircthr.daemon = True
+        ircthr.start()
+
+def main():
+    cfg = json.load(open('config.json', 'r', encoding='utf-8'))
+    loglevel = logging.DEBUG if sys.argv[-1] == '-d' else logging.INFO
+    loglistener = logsetup.setup(loglevel, cfg.get('logjson'), cfg.get('loglevels'))
+    init(cfg)
+    start()
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, profile_signal)
+        signal.signal(signal.SIGUSR2, profile_signal)
+    LOG.info('Satellite launched.')
+    try:
+        while 1:
+            try:
+                processmsg()
+            except Exception as ex:
+                LOG.exception('Failed to process a message.')
+                continue
+    finally:
+        STATE.close()
+        MSG_STORE.close()
+        if CAPTURE is not None:
+            CAPTURE.close()
+        LOG.info('Shut down cleanly.')
+        loglistener.stop()
+
+if __name__ == '__main__':
+    main()
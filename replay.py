@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+'''
+Replay a capture of the relay's input (see "capture" in README.md)
+through processmsg() and the IRC parser, without network access.
+
+Run: python3 replay.py CAPTURE [-c config.json] [-s SPEED] [-o OUTPUT]
+
+Bot API calls and IRC lines sent by the relay are written to OUTPUT as
+JSON lines instead of being sent, so the outputs of two versions of the
+relay on the same capture can be diffed. To make the output the same on
+every run, sends and downloads run one at a time in the replaying
+thread, IRC lines are not coalesced and IRC ids start from a fixed
+number.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import collections
+import concurrent.futures
+
+import libirc
+import capture
+import journal
+import metrics
+import relay
+
+# ids of sent messages, apart from the captured ones
+SENT_ID_BASE = 10 ** 9
+
+
+class Outbound:
+    '''Record of what the relay sends, in order.'''
+
+    def __init__(self, path):
+        self.fp = open(path, 'w', encoding='utf-8') if path else None
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.message_id = 0
+
+    def write(self, kind, record):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            if self.fp:
+                self.fp.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + '\n')
+
+    def bot_api(self, method, **params):
+        self.write(method, {'method': method, 'params': params})
+        if method == 'sendMessage':
+            with self.lock:
+                self.message_id += 1
+                message_id = self.message_id
+            return {
+                'message_id': SENT_ID_BASE + message_id,
+                'from': {'id': relay.CFG['botid'], 'first_name': relay.CFG['botname']},
+                'chat': {'id': params['chat_id']},
+                'date': int(time.time()),
+                'text': params.get('text', ''),
+            }
+        elif method == 'getFile':
+            return {'file_id': params['file_id'], 'file_path': 'replay/%s' % params['file_id']}
+        return True
+
+    def retrieve(self, url, filename, raisestatus=True):
+        self.write('download', {'method': 'download', 'url': url.rpartition('/')[2]})
+        open(filename, 'wb').close()
+        return 200
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+
+
+class SerialDispatcher:
+    '''
+    Stands in for relay.DISPATCHER: tasks run in the order they are
+    submitted, in the submitting thread. A task submitted by a running
+    task runs after it.
+    '''
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.running = False
+
+    def submit(self, key, func, *args, **kwargs):
+        self.queue.append((key, func, args, kwargs))
+        if self.running:
+            return
+        self.running = True
+        try:
+            while self.queue:
+                key, func, args, kwargs = self.queue.popleft()
+                try:
+                    func(*args, **kwargs)
+                except Exception:
+                    logging.exception('Dispatched task for %r failed.', key)
+        finally:
+            self.running = False
+
+    def stats(self):
+        return {}
+
+
+class SerialExecutor:
+    '''Stands in for relay.media_executor, running each job before submit() returns.'''
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as ex:
+            future.set_exception(ex)
+        return future
+
+
+class RecordingSocket:
+    '''Stands in for the IRC socket, recording every line sent.'''
+
+    def __init__(self, outbound):
+        self.outbound = outbound
+
+    def sendall(self, data):
+        for line in data.decode('utf-8', 'replace').splitlines():
+            self.outbound.write('irc', {'irc': line})
+
+    def close(self):
+        pass
+
+
+def drain():
+    while relay.MSG_Q.qsize():
+        relay.processmsg()
+
+
+def replay(records, speed):
+    '''Feed records to the relay. Returns (updates, IRC lines) replayed.'''
+    updates = lines = 0
+    start = first = None
+    for ts, source, payload in records:
+        if speed:
+            if first is None:
+                start, first = time.monotonic(), ts
+            delay = start + (ts - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        if source == 'tg':
+            for upd in payload:
+                relay.MSG_Q.put(upd)
+                updates += 1
+        elif source == 'irc':
+            msg = relay.ircconn.parse(line=payload)
+            if msg is not None:
+                relay.ircupdate(msg)
+            lines += 1
+        drain()
+    return updates, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a capture of the relay input.')
+    parser.add_argument('capture', help='capture file written by the relay')
+    parser.add_argument('-c', '--config', default='config.json', help='relay config (default: config.json)')
+    parser.add_argument('-s', '--speed', type=float, default=0,
+                        help='1 for recorded speed, 2 for twice as fast, 0 for as fast as possible (default)')
+    parser.add_argument('-o', '--output', help='write outbound calls here as JSON lines')
+    parser.add_argument('-d', '--debug', action='store_true', help='show the relay log')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, format='# %(asctime)s [%(levelname)s] %(message)s',
+                        level=logging.DEBUG if args.debug else logging.CRITICAL)
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        cfg = json.load(f)
+    workdir = tempfile.mkdtemp(prefix='relay-replay-')
+    # start from empty state, and don't capture or listen
+    cfg.update({
+        'msgstore': os.path.join(workdir, 'messages.db'),
+        'statefile': os.path.join(workdir, 'state.journal'),
+        'offset': 0,
+        'capture': None,
+        'webhook': None,
+        'metricsport': None,
+        'serveport': None,
+        # flushed by wall-clock time
+        'coalesce': 0,
+    })
+    if cfg.get('servemedia'):
+        # links are made up, downloads are recorded
+        cfg['servemedia'] = 'self'
+        cfg['serveurl'] = cfg.get('serveurl') or 'http://replay.invalid/'
+        cfg['cachepath'] = os.path.join(workdir, 'cache')
+        os.mkdir(cfg['cachepath'])
+    cfg.setdefault('botname', 'ReplayBot')
+
+    outbound = Outbound(args.output)
+    relay.init(cfg)
+    relay.bot_api = outbound.bot_api
+    relay.retrieve = outbound.retrieve
+    relay.DISPATCHER = SerialDispatcher()
+    relay.media_executor = SerialExecutor()
+    relay.IRC_IDS = journal.IdAllocator(relay.STATE, 'ircid', SENT_ID_BASE)
+    conn = libirc.IRCConnection()
+    conn.nick = cfg.get('ircnick')
+    conn.sock = RecordingSocket(outbound)
+    relay.ircconn = conn
+
+    start = time.perf_counter()
+    updates, lines = replay(capture.read(args.capture), args.speed)
+    elapsed = time.perf_counter() - start
+
+    relay.STATE.close()
+    relay.MSG_STORE.close()
+    outbound.close()
+    shutil.rmtree(workdir)
+    print('replayed %d updates and %d IRC lines in %.3fs (%.0f/s)' % (
+        updates, lines, elapsed, (updates + lines) / elapsed if elapsed else 0))
+    print('outbound: %s' % ', '.join('%s %d' % kv for kv in sorted(outbound.counts.items())))
+    for line in metrics.summary():
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())